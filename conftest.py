@@ -0,0 +1,2 @@
+# scripts/ holds command line tools, some of them Python 2 only
+collect_ignore = ["scripts"]
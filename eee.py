@@ -1,11 +1,20 @@
 #!/usr/bin/env python
 
-import glitches.dithering as gl_d
 import glitches.colour as gl_c
+import glitches.colourize as gl_cz
+import glitches.dithering as gl_d
 import glitches.util as gl_u
+import glitches.frames as gl_f
+import glitches.backends as gl_b
+import glitches.instrument as gl_i
 from PIL import Image, ImageOps
 import random
 from argparse import ArgumentParser
+import glob
+import multiprocessing
+import os
+import sys
+import time
 
 
 def random_hues(num):
@@ -20,65 +29,244 @@ def comp_colours(spread=0.1, c_min=0.2, c_max=0.4):
     return (a, b, c, d)
 
 
-def main():
-    parser = ArgumentParser()
-    parser.add_argument("inage", metavar='INPUT', type=str)
-    parser.add_argument("outage", metavar='OUTPUT', type=str)
-    parser.add_argument("-p", "--palette", type=str, default="AUTO")
-    parser.add_argument("-d", "--dither", type=str, default="BAYER")
-    parser.add_argument("-iw", "--width", type=int, default=-1)
-    parser.add_argument("-ih", "--height", type=int, default=-1)
-    parser.add_argument("-m", "--matrix", type=int, default=-2)
-    parser.add_argument("-e", "--equalize", action="store_true", default=False)
-    args = parser.parse_args()
-
-    image = Image.open(args.inage)
-
-    if args.equalize:
-        image = ImageOps.equalize(image)
-
+def target_palette(name):
     # Create target palette
-    if args.palette.upper() == "GB":
+    if name.upper() == "GB":
         out_palette = gl_c.GAMENIPPER
-    elif args.palette.upper() == "ISS":
+    elif name.upper() == "ISS":
         out_palette = gl_c.LOVE
-    elif args.palette.upper() == "AUTO":
+    elif name.upper() == "AUTO":
         out_palette = gl_c.hue_palette(comp_colours())
-    elif args.palette.upper() == "COMP":
+    elif name.upper() == "COMP":
         out_palette = gl_c.hue_palette(comp_colours(c_min=-0.1, c_max=0.1))
-    elif args.palette.upper() == "WHITE":
+    elif name.upper() == "WHITE":
         out_palette = [(0, 0, 0)]
         out_palette += gl_c.hue_palette((random.random(),), low=128)
         out_palette.append((255, 255, 255))
-    elif args.palette.upper() == "MONO":
+    elif name.upper() == "MONO":
         out_palette = gl_c.mono_palette(4)
     else:
         out_palette = gl_c.GAMENIPPER
-    num_colours = len(out_palette)
+    return out_palette
+
+
+def render(image, args, out_palette=None, loaded=False):
+    """ Render an image; `loaded` images come from `load` and are already
+    equalized and resized. """
+    if args.equalize and not loaded:
+        with gl_i.stage("equalize", gl_i.image_pixels(image)):
+            image = ImageOps.equalize(image)
+
+    if out_palette is None:
+        out_palette = target_palette(args.palette)
 
     # Resize Image
-    bgcolor = "rgb(%d, %d, %d)" % out_palette[0]
-    image = gl_u.resize(image, args.width, args.height)
-    
-    # Prequantize
-    image = gl_c.quantize(image, gl_c.mono_palette(num_colours * 4))
+    with gl_i.stage("resize") as st:
+        if not loaded:
+            image = gl_u.resize(image, args.width, args.height)
+        st.pixels = gl_i.image_pixels(image)
+
+    # Prequantize, dither to grey levels and replace them with the target
+    # palette in one pass
+    dither = "FS" if args.dither.upper() == "FS" else "BAYER"
+    with gl_i.stage("colourize", st.pixels, method=dither):
+        return gl_cz.colourize(image, out_palette, dither=dither,
+                               matrix=args.matrix)
+
+
+def load(path, args):
+    """ Load an image already equalized and shrunk to the output size. """
+    with gl_i.stage("load") as st:
+        image = gl_u.load(path, args.width, args.height,
+                          equalize=args.equalize)
+        st.pixels = gl_i.image_pixels(image)
+    return image
 
-    # Create monochrome palette for quantization
-    monos = gl_c.mono_palette(num_colours)
 
-    # Dither image based on monochrome palette
+def load_backend(args):
+    """ Load the dithering kernels up front, so their import and compile
+    cache are not counted as colourize time. Only Floyd-Steinberg uses
+    them. """
     if args.dither.upper() == "FS":
-        dithim = gl_d.floyd_steinberg(image, monos, mode="MONO").convert("RGB")
-    elif args.dither.upper() == "BAYER":
-        dithim = gl_d.bayer(image, monos, matrix=args.matrix).convert("RGB")
-    else:
-        dithim = gl_d.bayer(image, monos, matrix=args.matrix).convert("RGB")
+        with gl_i.stage("backend"):
+            gl_b.warm()
+
+
+def save(image, path):
+    with gl_i.stage("save", gl_i.image_pixels(image)):
+        image.save(path)
+
+
+# Clip mode
+
+
+def is_clip(path):
+    if gl_f.is_sequence(path):
+        return True
+    return getattr(Image.open(path), "n_frames", 1) > 1
+
+
+def run_clip(args):
+    # One palette for the whole clip
+    out_palette = target_palette(args.palette)
+
+    frames = gl_f.read_frames(args.inage)
+    frames = gl_f.pipeline(frames, lambda f: render(f, args, out_palette))
+    gl_f.write_frames(frames, args.outage, gl_f.frame_duration(args.inage))
+
+
+# Batch mode
+
+batch_args = None
+
+
+def batch_inputs(pattern):
+    """ Files in a directory, or files matching a glob pattern. """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*")
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+
+
+def batch_output(template, index, path):
+    """ Output path for an input, from a template such as "out/{stem}.png".
+
+    Fields are {stem}, {ext}, {name} and {index}. A template without fields
+    is taken as a directory to write files of the same name into.
+    """
+    name = os.path.basename(path)
+    stem, ext = os.path.splitext(name)
+    if "{" not in template:
+        return os.path.join(template, name)
+    return template.format(stem=stem, ext=ext, name=name, index=index)
+
+
+def batch_init(args):
+    global batch_args
+    batch_args = args
+
+    # Forked workers would otherwise share one sequence of random palettes
+    random.seed()
+
+    if args.profile:
+        gl_i.start_tracing()
+
+    # Warm palettes and kernels so the first real image pays no setup
+    gl_b.warm()
+    warm = Image.new("RGB", (16, 16), "gray")
+    try:
+        render(warm, args)
+    except Exception as e:
+        sys.stderr.write("warm-up failed in worker %d: %s: %s\n" %
+                         (os.getpid(), type(e).__name__, e))
+
+
+def batch_render(job):
+    index, inpath, outpath = job
+    start = time.time()
+    with gl_i.Recorder() as recorder:
+        try:
+            outim = render(load(inpath, batch_args), batch_args,
+                           loaded=True)
+            outdir = os.path.dirname(outpath)
+            if outdir and not os.path.isdir(outdir):
+                try:
+                    os.makedirs(outdir)
+                except OSError:
+                    pass
+            save(outim, outpath)
+            error = None
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+    return inpath, outpath, time.time() - start, error, recorder.events
+
+
+def run_batch(args, profile=None):
+    inputs = batch_inputs(args.inage)
+    jobs = [(i, path, batch_output(args.outage, i, path))
+            for i, path in enumerate(inputs)]
+
+    start = time.time()
+    failures = 0
+    pool = multiprocessing.Pool(args.jobs, batch_init, (args,))
+    try:
+        for inpath, outpath, elapsed, error, events in pool.imap_unordered(
+                batch_render, jobs):
+            if profile is not None:
+                for event in events:
+                    event["file"] = inpath
+                    profile(event)
+            if error is None:
+                sys.stderr.write("ok %.3fs %s -> %s\n" %
+                                 (elapsed, inpath, outpath))
+            else:
+                failures += 1
+                sys.stderr.write("FAILED %.3fs %s: %s\n" %
+                                 (elapsed, inpath, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    sys.stderr.write("%d files, %d failed, %.3fs\n" %
+                     (len(jobs), failures, time.time() - start))
+    return failures
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("inage", metavar='INPUT', type=str)
+    parser.add_argument("outage", metavar='OUTPUT', type=str)
+    parser.add_argument("-p", "--palette", type=str, default="AUTO")
+    parser.add_argument("-d", "--dither", type=str, default="BAYER")
+    parser.add_argument("-iw", "--width", type=int, default=-1)
+    parser.add_argument("-ih", "--height", type=int, default=-1)
+    parser.add_argument("-m", "--matrix", type=int, default=4,
+                        help="Bayer matrix size: 2, 3, 4 or 8")
+    parser.add_argument("-e", "--equalize", action="store_true", default=False)
+    parser.add_argument("-b", "--batch", action="store_true", default=False,
+                        help="INPUT is a directory or glob pattern and OUTPUT "
+                             "a directory or template like out/{stem}.png")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="write per-stage timings and memory as JSON "
+                             "lines to stderr")
+    parser.add_argument("--profile-file", type=str, default=None,
+                        help="write the --profile output to this file")
+    args = parser.parse_args()
+    if args.dither.upper() != "FS" and gl_d.bayer_matrix(args.matrix) is None:
+        parser.error("no %dx%d Bayer matrix, use 2, 3, 4 or 8" %
+                     (args.matrix, args.matrix))
+
+    profile = None
+    if args.profile or args.profile_file:
+        args.profile = True
+        if args.profile_file:
+            stream = open(args.profile_file, "w")
+        else:
+            stream = sys.stderr
+        profile = gl_i.json_writer(stream)
+        gl_i.start_tracing()
+
+    if args.batch:
+        sys.exit(1 if run_batch(args, profile) else 0)
+
+    if profile is not None:
+        gl_i.subscribe(profile)
+
+    if is_clip(args.inage):
+        if gl_f.is_sequence(args.inage) and \
+                not gl_f.sequence_paths(args.inage):
+            parser.error("no frames match %s" % args.inage)
+        load_backend(args)
+        run_clip(args)
+        return
 
-    # Replace colours in image with target palette
-    outim = gl_c.replace_colours(dithim, monos, out_palette)
+    load_backend(args)
+    image = load(args.inage, args)
+    outim = render(image, args, loaded=True)
 
     # Save dithered coloured image
-    outim.save(args.outage)
+    save(outim, args.outage)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,223 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Kernel backends. Each backend provides the same kernels (see
+# glitches.kernels) and is only imported when first asked for, so importing
+# glitches never pulls in a compiler. numba is the expected backend; the
+# "python" fallback runs the same loops in the interpreter and is several
+# hundred times slower (seconds for a 256x256 Floyd-Steinberg dither).
+
+
+# Floyd-Steinberg working precisions; "double" is the reference
+PRECISIONS = ("double", "float32", "int32", "int16")
+
+
+class Backend(object):
+    """ A set of kernels. Fixed-point and palette grid kernels are
+    optional; a backend without them only dithers in floating point, or
+    scans the whole palette. """
+    def __init__(self, name, fs_mono, fs_rgb, fs_mono_fixed=None,
+                 fs_rgb_fixed=None, fs_rgb_grid=None, fs_rgb_fixed_grid=None,
+                 precisions=PRECISIONS):
+        self.name = name
+        self.fs_mono = fs_mono
+        self.fs_rgb = fs_rgb
+        self.fs_mono_fixed = fs_mono_fixed
+        self.fs_rgb_fixed = fs_rgb_fixed
+        self.fs_rgb_grid = fs_rgb_grid
+        self.fs_rgb_fixed_grid = fs_rgb_fixed_grid
+        self.precisions = precisions
+
+    def fs(self, mode, precision="double", grid=False):
+        """ Floyd-Steinberg kernel for "MONO" or "RGB" at a precision.
+
+        With `grid`, the RGB kernel searching a palette grid, or None if
+        the backend has none.
+        """
+        fixed = precision in ("int32", "int16")
+        if mode == "MONO":
+            return self.fs_mono_fixed if fixed else self.fs_mono
+        if grid:
+            return self.fs_rgb_fixed_grid if fixed else self.fs_rgb_grid
+        return self.fs_rgb_fixed if fixed else self.fs_rgb
+
+    def __repr__(self):
+        return "Backend(%r)" % self.name
+
+
+def load_python():
+    """ Plain Python kernels; always available, but slow. """
+    from glitches import kernels
+    return Backend("python", kernels.fs_mono, kernels.fs_rgb,
+                   kernels.fs_mono_fixed, kernels.fs_rgb_fixed,
+                   kernels.fs_rgb_grid, kernels.fs_rgb_fixed_grid)
+
+
+def load_numba():
+    """ Kernels JIT-compiled by numba. They release the GIL and are cached
+    on disk after the first compile. """
+    import numba
+    from glitches import kernels
+    jit = numba.njit(nogil=True, cache=True)
+    return Backend("numba", jit(kernels.fs_mono), jit(kernels.fs_rgb),
+                   jit(kernels.fs_mono_fixed), jit(kernels.fs_rgb_fixed),
+                   jit(kernels.fs_rgb_grid), jit(kernels.fs_rgb_fixed_grid))
+
+
+def load_weave():
+    """ C++ kernels compiled by scipy.weave (SciPy < 0.15 only). """
+    from glitches import weave_kernels
+    return Backend("weave", weave_kernels.fs_mono, weave_kernels.fs_rgb,
+                   precisions=("double",))
+
+
+# Backends in order of preference
+registry = OrderedDict([
+    ("numba", load_numba),
+    ("weave", load_weave),
+    ("python", load_python),
+])
+
+loaded = {}
+active = []
+lock = threading.Lock()
+
+
+def register(name, loader, first=False):
+    """ Add a backend; `loader()` returns a Backend or raises ImportError. """
+    registry[name] = loader
+    if first:
+        for other in [n for n in registry if n != name]:
+            registry[other] = registry.pop(other)
+
+
+def load(name):
+    if name not in registry:
+        raise ValueError("unknown glitches backend %r, expected one of %s" %
+                         (name, ", ".join(registry)))
+    with lock:
+        if name not in loaded:
+            loaded[name] = registry[name]()
+        return loaded[name]
+
+
+def available():
+    """ Names of the backends that can be loaded here. """
+    names = []
+    for name in registry:
+        try:
+            load(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def set_backend(name):
+    """ Use the named backend from now on. """
+    backend = load(name)
+    active[:] = [backend]
+    return backend
+
+
+def get_backend(name=None, precision=None, kernel=None):
+    """ The named backend, or the active one.
+
+    The active backend is chosen on first use: $GLITCHES_BACKEND if set,
+    otherwise the first backend in the registry that loads. If it has no
+    kernels for `precision`, or lacks the optional `kernel` (an attribute
+    name such as "fs_rgb_grid"), the first loadable backend that has them
+    is returned instead.
+    """
+    if name is not None:
+        return load(name)
+
+    def supports(backend):
+        return ((precision is None or precision in backend.precisions) and
+                (kernel is None or getattr(backend, kernel) is not None))
+
+    backend = active_backend()
+    if supports(backend):
+        return backend
+
+    for name in registry:
+        try:
+            other = load(name)
+        except ImportError:
+            continue
+        if supports(other):
+            return other
+    raise ImportError("no glitches backend supports %s" %
+                      ", ".join(str(v) for v in (precision, kernel) if v))
+
+
+def active_backend():
+    if active:
+        return active[0]
+
+    names = list(registry)
+    env = os.environ.get("GLITCHES_BACKEND")
+    if env:
+        names = [env]
+    for name in names:
+        try:
+            return set_backend(name)
+        except ImportError:
+            continue
+    raise ImportError("no usable glitches backend among %s" % names)
+
+
+def warm(name=None):
+    """ Compile (or load the compiled) kernels of a backend ahead of use. """
+    from glitches.kernels import NO_INDICES
+    backend = get_backend(name)
+    mono = np.array([0.0, 255.0])
+    rgb = np.array([[0.0, 0.0, 0.0], [255.0, 255.0, 255.0]])
+    none = NO_INDICES
+
+    # Cached palettes are read-only, which numba compiles for separately
+    for pal in (mono, rgb):
+        pal.flags.writeable = False
+    backend.fs_mono(np.zeros((2, 2)), mono, 0, 2, 0, 2, none)
+    backend.fs_mono(np.zeros((2, 2)), np.array([]), 0, 2, 0, 2, none)
+    backend.fs_rgb(np.zeros((2, 2, 3)), rgb, 0, 2, 0, 2, none)
+    if "float32" in backend.precisions:
+        backend.fs_mono(np.zeros((2, 2), np.float32), mono, 0, 2, 0, 2,
+                        none)
+        backend.fs_rgb(np.zeros((2, 2, 3), np.float32), rgb, 0, 2, 0, 2,
+                       none)
+    if backend.fs_mono_fixed is not None:
+        fixed_mono = np.array([0, 255 << 4], dtype=np.intp)
+        fixed_rgb = np.array([[0, 0, 0], [255 << 4] * 3], dtype=np.intp)
+        for pal in (fixed_mono, fixed_rgb):
+            pal.flags.writeable = False
+        for dtype in (np.int32, np.int16):
+            backend.fs_mono_fixed(np.zeros((2, 2), dtype), fixed_mono,
+                                  0, 2, 0, 2, none)
+            backend.fs_mono_fixed(np.zeros((2, 2), dtype),
+                                  np.array([], dtype=np.intp), 0, 2, 0, 2,
+                                  none)
+            backend.fs_rgb_fixed(np.zeros((2, 2, 3), dtype), fixed_rgb,
+                                 0, 2, 0, 2, none)
+    if backend.fs_rgb_grid is not None:
+        from glitches.lut import palette_grid
+        grid = palette_grid(rgb)
+        for dtype in (np.double, np.float32):
+            backend.fs_rgb_grid(np.zeros((2, 2, 3), dtype), rgb, 0, 2, 0, 2,
+                                none, grid.start, grid.items, grid.bits)
+        for dtype in (np.int32, np.int16):
+            backend.fs_rgb_fixed_grid(np.zeros((2, 2, 3), dtype), fixed_rgb,
+                                      0, 2, 0, 2, none, grid.start,
+                                      grid.items, grid.bits)
+    return backend
+
+
+if __name__ == '__main__':
+    # Build the on-disk kernel caches, e.g. while deploying workers
+    for name in available():
+        warm(name)
+        print(name)
@@ -0,0 +1,114 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Palette-keyed cache of derived structures
+
+
+def palette_key(palette):
+    """ Hash identifying a palette by its colour values. """
+    pal = np.ascontiguousarray(palette, dtype=np.double)
+    digest = hashlib.sha1(pal.tobytes()).hexdigest()
+    return digest, pal.shape
+
+
+def sizeof(value):
+    """ Approximate number of bytes held by a cached value. """
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    elif isinstance(value, (tuple, list)):
+        return sum(sizeof(v) for v in value)
+    elif isinstance(value, dict):
+        return 64 * len(value)
+    return 0
+
+
+class PaletteCache(object):
+    """ LRU cache for structures derived from a palette.
+
+    Entries are keyed by the palette hash plus a `kind` naming the derived
+    structure, e.g. ("array", "uint8") or ("colormap", 6). Least recently used
+    entries are dropped once the cached values exceed `max_bytes`; the most
+    recent entry is always kept, however large.
+    """
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, palette, kind, build):
+        """ Return the cached value for (palette, kind), calling `build()`
+        to create it on a miss.
+
+        The lock is only held to look up and insert entries, so a slow build
+        never holds up hits from other threads. Threads missing on the same
+        key at once may each build it; the first value stored wins.
+        """
+        key = (palette_key(palette), kind)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                value, size = self._entries.pop(key)
+                self._entries[key] = (value, size)
+                return value
+            self.misses += 1
+
+        value = build()
+        size = sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                value, size = self._entries.pop(key)
+                self.nbytes -= size
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+            return value
+
+    def set_limit(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"entries": len(self._entries), "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses}
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.nbytes -= size
+
+
+# Process-wide cache shared by the colour and dithering code
+palettes = PaletteCache()
+
+
+def palette_array(palette, dtype=np.double):
+    """ Read-only array of palette colours, cached per palette and dtype. """
+    dtype = np.dtype(dtype)
+
+    def build():
+        pal_array = np.array(palette, dtype=dtype)
+        pal_array.flags.writeable = False
+        return pal_array
+    return palettes.get(palette, ("array", dtype.str), build)
+
+
+# End of palette-keyed cache code
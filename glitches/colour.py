@@ -1,180 +1,467 @@
 #!/usr/bin/env python
 
 from PIL import Image, ImageDraw
-import math
+import heapq
 from operator import itemgetter
-from scipy.weave import inline, converters
 import numpy as np
 import colorsys
 
+from glitches.cache import palettes, palette_array
+from glitches.lut import inverse_colormap
+
 
 # Median-cut algorithm code
 
 class Box(object):
-    def __init__(self, colours=None):
+    def __init__(self, colours=None, weights=None):
         # Setup colours
         if colours is None:
-            self.colours = []
-            self._r0 = 0
-            self._r1 = 255
-            self._g0 = 0
-            self._g1 = 255
-            self._b0 = 0
-            self._b1 = 255
+            self.colours = np.empty((0, 3), dtype=np.intp)
+            self.weights = np.empty(0, dtype=np.intp)
+            self.lo = np.zeros(3, dtype=np.intp)
+            self.hi = np.full(3, 255, dtype=np.intp)
         else:
-            self.colours = colours
+            self.colours = np.asarray(colours, dtype=np.intp).reshape((-1, 3))
+            if weights is None:
+                self.weights = np.ones(self.colours.shape[0], dtype=np.intp)
+            else:
+                self.weights = np.asarray(weights, dtype=np.intp)
             self.resize()
 
     @property
     def rsize(self):
-        return self._r1 - self._r0
+        return int(self.hi[0] - self.lo[0])
 
     @property
     def gsize(self):
-        return self._g1 - self._g0
+        return int(self.hi[1] - self.lo[1])
 
     @property
     def bsize(self):
-        return self._b1 - self._b0
+        return int(self.hi[2] - self.lo[2])
 
     @property
     def size(self):
         return (self.rsize, self.gsize, self.bsize)
 
+    @property
+    def longest(self):
+        """ Longest dimension as (size, axis), lowest axis first on ties. """
+        extent = self.hi - self.lo
+        axis = int(np.argmax(extent))
+        return int(extent[axis]), axis
+
     @property
     def avg(self):
-        n = len(self.colours)
-        r = int(math.floor(sum(col[0] for col in self.colours) / n))
-        g = int(math.floor(sum(col[1] for col in self.colours) / n))
-        b = int(math.floor(sum(col[2] for col in self.colours) / n))
-        return r, g, b
+        total = self.weights.sum()
+        r, g, b = np.dot(self.weights, self.colours) // total
+        return int(r), int(g), int(b)
 
     def resize(self):
-        self._r0 = min(col[0] for col in self.colours)
-        self._r1 = max(col[0] for col in self.colours)
-        self._g0 = min(col[1] for col in self.colours)
-        self._g1 = max(col[1] for col in self.colours)
-        self._b0 = min(col[2] for col in self.colours)
-        self._b1 = max(col[2] for col in self.colours)
+        self.lo = self.colours.min(axis=0)
+        self.hi = self.colours.max(axis=0)
 
     def split(self, axis):
-        # Sort colours by axis
-        self.colours = sorted(self.colours, key=itemgetter(axis))
-
-        # Find median
-        med_idx = len(self.colours) / 2
+        values = self.colours[:, axis]
+        target = self.weights.sum() // 2
+
+        # Find the median value from a per-value histogram of the weights
+        hist = np.bincount(values, weights=self.weights, minlength=256)
+        med = int(np.searchsorted(np.cumsum(hist), target))
+
+        # Colours below the median go low, colours equal to it are taken in
+        # their existing order until the low side holds half the weight
+        lower = values < med
+        equal = np.flatnonzero(values == med)
+        remaining = target - self.weights[lower].sum()
+        lower[equal[np.cumsum(self.weights[equal]) <= remaining]] = True
+        if not lower.any() and equal.size:
+            lower[equal[0]] = True
 
         # Create splits
-        a = self.colours[:med_idx]
-        if len(a) > 0:
-            aa = Box(a)
+        a = lower
+        if a.any():
+            aa = Box(self.colours[a], self.weights[a])
         else:
             aa = None
 
-        b = self.colours[med_idx:]
-        if len(b) > 0:
-            bb = Box(b)
+        b = ~lower
+        if b.any():
+            bb = Box(self.colours[b], self.weights[b])
         else:
             bb = None
 
         return aa, bb
 
 
+def colour_histogram(image, bits=8):
+    """ Distinct colours of an image and their pixel counts.
+
+    Pixels are packed into integers of `bits` bits per channel and counted
+    with NumPy. With fewer than 8 bits, similar colours share a bin and the
+    bin is represented by the mean of its pixels. Returns (colours, counts)
+    arrays ordered by descending count.
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    pixels = np.asarray(image).reshape((-1, 3))
+    shift = 8 - bits
+
+    # Pack pixels into one integer each
+    keys = (pixels[:, 0] >> shift).astype(np.intp) << (2 * bits)
+    keys |= (pixels[:, 1] >> shift).astype(np.intp) << bits
+    keys |= pixels[:, 2] >> shift
+
+    if 3 * bits <= 21:
+        counts = np.bincount(keys, minlength=1 << (3 * bits))
+        bins = np.flatnonzero(counts)
+        counts = counts[bins]
+    else:
+        bins, counts = np.unique(keys, return_counts=True)
+
+    if shift == 0:
+        mask = (1 << bits) - 1
+        colours = np.column_stack((bins >> (2 * bits), (bins >> bits) & mask,
+                                   bins & mask))
+    else:
+        # Mean colour of the pixels in each bin
+        sums = [np.bincount(keys, weights=pixels[:, band],
+                            minlength=1 << (3 * bits))[bins]
+                for band in range(3)]
+        colours = np.column_stack(sums) // counts[:, None]
+        colours = colours.astype(np.intp)
+
+    order = np.argsort(-counts, kind='mergesort')
+    return colours[order], counts[order]
+
+
 def get_colours(image):
-    colours = image.getcolors(image.size[0] * image.size[1])
-    colours = sorted(colours, key=itemgetter(0), reverse=True)
-    return [c[1] for c in colours]
-
-
-def median_cut(image, num_colours):
-    colours = get_colours(image)
-
-    # Create initial box
-    boxes = [Box(colours)]
-
-    # Find longest dimension/box
-    while len(boxes) < num_colours:
-        longest_box = -1
-        longest_dim = -1
-        longest_size = -1
-        for b in range(len(boxes)):
-            size = boxes[b].size
-            for d in range(3):
-                if size[d] > longest_size:
-                    longest_box = b
-                    longest_dim = d
-                    longest_size = size[d]
-        if longest_size <= 1:
+    colours, _ = colour_histogram(image)
+    return [tuple(int(v) for v in c) for c in colours]
+
+
+def median_cut(image, num_colours, bits=8, weighted=True):
+    """ Median-cut palette of `num_colours` colours.
+
+    Boxes are split and averaged by pixel count unless `weighted` is False,
+    in which case every distinct colour counts once. `bits` reduces the
+    colour depth of the histogram before cutting.
+    """
+    colours, counts = colour_histogram(image, bits)
+    if not weighted:
+        counts = None
+    return cut_colours(colours, counts, num_colours)
+
+
+def cut_colours(colours, counts, num_colours):
+    """ Median-cut palette of an (N, 3) array of colours weighted by
+    `counts` (or all equally if None). """
+    # Boxes are queued by longest dimension; ties go to the box that comes
+    # first in palette order, which is tracked by each box's split path
+    box = Box(colours, counts)
+    size, axis = box.longest
+    queue = [(-size, (), axis, box)]
+
+    while len(queue) < num_colours:
+        # Find longest dimension/box
+        size, path, axis, split_box = heapq.heappop(queue)
+        if -size <= 1:
+            heapq.heappush(queue, (size, path, axis, split_box))
             break
 
         # Split longest dimension/box
-        split_box = boxes[longest_box]
-        a, b = split_box.split(longest_dim)
-        splits = []
-        if a is not None:
-            splits.append(a)
-        if b is not None:
-            splits.append(b)
-
-        if len(splits) == 0:
-            break
-
-        # Replace split box
-        boxes = boxes[:longest_box] + splits + boxes[longest_box+1:]
+        for side, box in enumerate(split_box.split(axis)):
+            if box is not None:
+                size, axis = box.longest
+                heapq.heappush(queue, (-size, path + (side,), axis, box))
 
     # Average colours
-    colours = [x.avg for x in boxes]
+    colours = [box.avg for _, _, _, box in sorted(queue, key=itemgetter(1))]
 
     return colours
 
 
 # End of median-cut algorithm code
 
-def quantize(image, pal):
-    pal_array = np.array(pal, dtype=np.uint8)
-    im_array = np.reshape(np.array(image), (image.size[0] * image.size[1], 3))
-
-    nx = im_array.shape[0]  # noqa
-    nc = pal_array.shape[0]  # noqa
-
-    code = """
-        int nearest_colour;
-        double nearest_distance, dist, tmp;
-        for (int i=0; i<nx; ++i)
-        {
-            nearest_colour = -1;
-            nearest_distance = -1;
-
-            // Find Nearest Colour
-            for (int c=0; c<nc; ++c)
-            {
-                dist = 0;
-                for (int band = 0; band < 3; band++)
-                {
-                    tmp = im_array(i, band) - pal_array(c, band);
-                    dist += tmp * tmp;
-                }
-                if (nearest_colour == -1 || dist < nearest_distance)
-                {
-                    nearest_colour = c;
-                    nearest_distance = dist;
-                }
-            }
-
-            for (int band = 0; band < 3; band++)
-            {
-                im_array(i,band) = pal_array(nearest_colour, band);
-            }
-        }
-        """
 
-    inline(code, ['nx', 'im_array', 'pal_array', 'nc'],
-           type_converters=converters.blitz)
+# Octree quantizer code
+
+
+def octree_keys(pixels):
+    """ Octree path of each pixel of an (N, 3) uint8 array as one integer.
+
+    Each level of the tree takes one bit of every channel, most significant
+    first, so the node containing a pixel at depth d is `key >> 3 * (8 - d)`.
+    """
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    keys = np.zeros(pixels.shape[0], dtype=np.int64)
+    for bit in range(7, -1, -1):
+        keys <<= 3
+        keys |= ((pixels[:, 0] >> bit) & 1).astype(np.int64) << 2
+        keys |= ((pixels[:, 1] >> bit) & 1).astype(np.int64) << 1
+        keys |= (pixels[:, 2] >> bit) & 1
+    return keys
+
+
+def pixel_chunks(source, chunk):
+    """ (N, 3) uint8 arrays of at most `chunk` pixels from an image, an
+    (..., 3) array or an iterable of either, e.g. `read_frames(...)`. """
+    if isinstance(source, Image.Image):
+        w, h = source.size
+        step = max(1, chunk // max(w, 1))
+        for y in range(0, h, step):
+            strip = source.crop((0, y, w, min(h, y + step))).convert("RGB")
+            yield np.asarray(strip).reshape((-1, 3))
+    elif isinstance(source, np.ndarray):
+        flat = source.reshape((-1, 3))
+        for i in range(0, flat.shape[0], chunk):
+            yield np.asarray(flat[i:i + chunk], dtype=np.uint8)
+    else:
+        for item in source:
+            for pixels in pixel_chunks(item, chunk):
+                yield pixels
+
+
+class Octree(object):
+    """ Colour histogram octree built incrementally with a bounded number
+    of leaves.
+
+    Only leaves are stored, as parallel arrays of depth, node code, pixel
+    count and channel sums, sorted by depth and code. Pixels are added in
+    chunks; whenever there are more than `max_leaves` leaves, the deepest
+    leaves with the fewest pixels are merged into their parents. Memory is
+    set by `max_leaves` and the chunk size, not by the number of distinct
+    colours seen.
+    """
+    def __init__(self, max_leaves=4096):
+        self.max_leaves = max_leaves
+        self.depth = np.empty(0, dtype=np.int64)
+        self.code = np.empty(0, dtype=np.int64)
+        self.count = np.empty(0, dtype=np.int64)
+        self.sums = np.empty((0, 3), dtype=np.int64)
+
+    def __len__(self):
+        return self.code.shape[0]
 
-    im_array = np.reshape(im_array, (image.size[1], image.size[0], 3))
+    @property
+    def nbytes(self):
+        return (self.depth.nbytes + self.code.nbytes + self.count.nbytes +
+                self.sums.nbytes)
+
+    def sort(self):
+        order = np.argsort((self.depth << 24) | self.code, kind='mergesort')
+        self.depth = self.depth[order]
+        self.code = self.code[order]
+        self.count = self.count[order]
+        self.sums = self.sums[order]
+
+    def add(self, pixels):
+        """ Add an (N, 3) uint8 array of pixels. """
+        pixels = np.asarray(pixels, dtype=np.uint8).reshape((-1, 3))
+        if pixels.shape[0] == 0:
+            return
+        keys, inverse, counts = np.unique(octree_keys(pixels),
+                                          return_inverse=True,
+                                          return_counts=True)
+        sums = np.column_stack([np.bincount(inverse.ravel(),
+                                            weights=pixels[:, band],
+                                            minlength=keys.size)
+                                for band in range(3)]).astype(np.int64)
+
+        # Leaves are prefix-free, so each key lies under at most one leaf
+        leaf = np.full(keys.size, -1, dtype=np.intp)
+        if len(self):
+            full = (self.depth << 24) | self.code
+            for d in np.unique(self.depth):
+                query = (int(d) << 24) | (keys >> 3 * (8 - int(d)))
+                pos = np.minimum(np.searchsorted(full, query), len(self) - 1)
+                found = (full[pos] == query) & (leaf < 0)
+                leaf[found] = pos[found]
+
+        known = leaf >= 0
+        np.add.at(self.count, leaf[known], counts[known])
+        np.add.at(self.sums, leaf[known], sums[known])
+
+        # Everything else starts as a new full-depth leaf
+        new = ~known
+        if new.any():
+            self.depth = np.concatenate((self.depth,
+                                         np.full(new.sum(), 8, np.int64)))
+            self.code = np.concatenate((self.code, keys[new]))
+            self.count = np.concatenate((self.count, counts[new]))
+            self.sums = np.concatenate((self.sums, sums[new]))
+            self.sort()
+
+        if len(self) > self.max_leaves:
+            self.reduce(self.max_leaves)
+
+    def reduce(self, limit):
+        """ Merge leaves until there are at most `limit`.
+
+        Parents at the deepest level are merged fewest pixels first. Whole
+        parents are merged, so at most one merge may overshoot the limit
+        when no smaller merge fits.
+        """
+        while len(self) > limit and self.depth.max() > 0:
+            d = self.depth.max()
+            sel = np.flatnonzero(self.depth == d)
+            parents, inverse, children = np.unique(self.code[sel] >> 3,
+                                                   return_inverse=True,
+                                                   return_counts=True)
+            inverse = inverse.ravel()
+            totals = np.bincount(inverse, weights=self.count[sel])
+            order = np.argsort(totals, kind='mergesort')
+            gain = children[order] - 1
+
+            excess = len(self) - limit
+            if gain.sum() <= excess:
+                take = order
+            else:
+                # The smallest parents, then any others that still fit,
+                # overshooting with one more if none does
+                fits = np.cumsum(gain) <= excess
+                take = list(order[fits])
+                left = excess - gain[fits].sum()
+                over = None
+                for parent, g in zip(order[~fits], gain[~fits]):
+                    if left <= 0:
+                        break
+                    if g <= left:
+                        take.append(parent)
+                        left -= g
+                    elif over is None:
+                        over = parent
+                if left > 0:
+                    take.append(over)
+                take = np.array(take, dtype=np.intp)
+
+            chosen = np.zeros(parents.size, dtype=bool)
+            chosen[take] = True
+            merged = sel[chosen[inverse]]
+            self.merge(merged, d)
+
+    def merge(self, leaves, depth):
+        """ Replace `leaves`, all at `depth`, by their parents. """
+        parents, inverse = np.unique(self.code[leaves] >> 3,
+                                     return_inverse=True)
+        inverse = inverse.ravel()
+        count = np.bincount(inverse, weights=self.count[leaves])
+        sums = np.column_stack([np.bincount(inverse,
+                                            weights=self.sums[leaves, band])
+                                for band in range(3)])
+
+        keep = np.ones(len(self), dtype=bool)
+        keep[leaves] = False
+        self.depth = np.concatenate((self.depth[keep],
+                                     np.full(parents.size, depth - 1,
+                                             np.int64)))
+        self.code = np.concatenate((self.code[keep], parents))
+        self.count = np.concatenate((self.count[keep],
+                                     count.astype(np.int64)))
+        self.sums = np.concatenate((self.sums[keep], sums.astype(np.int64)))
+        self.sort()
+
+    def colours(self):
+        """ Mean colour of each leaf and its pixel count. """
+        colours = self.sums // np.maximum(self.count, 1)[:, None]
+        return colours, self.count
+
+    def palette(self, num_colours):
+        """ Palette of `num_colours` colours from the leaves.
+
+        Leaf colours are combined by a pixel-weighted median cut, which,
+        unlike merging whole octree nodes, gives exactly `num_colours`
+        colours whenever there are that many leaves. More pixels may still
+        be added afterwards.
+        """
+        if not len(self):
+            return []
+        colours, counts = self.colours()
+        return cut_colours(colours, counts, num_colours)
+
+
+def octree_palette(source, num_colours, max_leaves=4096, chunk=1 << 16):
+    """ Palette of `num_colours` colours in one pass over `source`.
+
+    `source` is an image, an (..., 3) uint8 array (which may be memory
+    mapped) or an iterable of either, such as the frames of a clip. Pixels
+    are read `chunk` at a time into an `Octree` of at most `max_leaves`
+    leaves, so memory does not grow with the image or its colours.
+    """
+    tree = Octree(max(max_leaves, num_colours))
+    for pixels in pixel_chunks(source, chunk):
+        tree.add(pixels)
+    return tree.palette(num_colours)
+
+
+# End of octree quantizer code
+
+def quantize(image, pal, metric="rgb", indexed=False):
+    """ Map every pixel to its nearest palette colour.
+
+    `metric` is "rgb" or "lab" (see glitches.lut.METRICS). With `indexed`,
+    a "P" image holding `pal` is returned instead of an RGB one.
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    im_array = quantize_array(np.asarray(image), pal, metric,
+                              indexed=indexed)
+    if indexed:
+        return indexed_image(im_array, pal)
     return Image.fromarray(im_array)
 
 
+def quantize_array(im_array, pal, metric="rgb", out=None, indexed=False):
+    """ Quantize a uint8 (h, w, 3) array, e.g. a memory-mapped tile, into
+    `out`. With `indexed`, the result is the (h, w) plane of palette
+    indices. """
+    pal_array = palette_array(pal, np.uint8)
+    indices = inverse_colormap(pal_array, metric=metric).map(im_array)
+    if indexed:
+        if out is None:
+            return indices
+        out[...] = indices
+        return out
+    if out is None:
+        return pal_array[indices]
+    np.take(pal_array, indices, axis=0, out=out)
+    return out
+
+
+# Indexed images. A "P" image holds one byte per pixel indexing a palette of
+# up to 256 colours, a third of the memory of RGB, and recolouring it only
+# means swapping its palette.
+
+
+def indexed_colours(pal):
+    """ Palette as a uint8 (n, 3) array for images of uint8 indices.
+
+    Raises ValueError if it has more than 256 colours.
+    """
+    pal_array = palette_array(pal, np.uint8).reshape((-1, 3))
+    if pal_array.shape[0] > 256:
+        raise ValueError("indexed images hold at most 256 colours, not %d" %
+                         pal_array.shape[0])
+    return pal_array
+
+
+def indexed_image(indices, pal):
+    """ "P" image from an (h, w) array of indices into `pal`. """
+    pal_array = indexed_colours(pal)
+    image = Image.fromarray(np.asarray(indices, dtype=np.uint8), "P")
+    image.putpalette(pal_array.ravel().tolist())
+    return image
+
+
+def image_indices(image):
+    """ (indices, palette) of a "P" image: the (h, w) uint8 index array and
+    the palette as an (n, 3) uint8 array. """
+    if image.mode != "P":
+        raise ValueError("not an indexed image: %s" % image.mode)
+    pal = image.getpalette("RGB")
+    return np.asarray(image), np.array(pal, dtype=np.uint8).reshape((-1, 3))
+
+
 # Palette generation, manipulation, visualization.
 
 
@@ -229,23 +516,116 @@ def swatch(palette, fname):
     image.save(fname)
 
 
-def replace_colours(image, pal_a, pal_b):
-    def hash_col(col):
-        r, g, b = col
-        hcol = (int(r) << 16) + (int(g) << 8) + int(b)
-        return hcol
-    # Prepare the palettes
-    from_pal = {hash_col(pal_a[i]): i for i in range(len(pal_a))}
-    to_pal = {i: pal_b[i] for i in range(len(pal_b))}
-
-    im_array = np.array(image.convert("RGB"))
-    im_array = np.reshape(im_array, (im_array.shape[0] * im_array.shape[1], 3))
-    for p in xrange(im_array.shape[0]):
-        old_col = from_pal[hash_col(im_array[p])]
-        new_col = to_pal[old_col]
-        im_array[p] = new_col
-    im_array = np.reshape(im_array, (image.size[1], image.size[0], 3))
-    return Image.fromarray(im_array)
+def hash_colours(colours):
+    """ Pack an (..., 3) array of colours into 24-bit integers. """
+    colours = np.asarray(colours).astype(np.intp)
+    return (colours[..., 0] << 16) + (colours[..., 1] << 8) + colours[..., 2]
+
+
+def palette_keys(pal):
+    """ Sorted 24-bit keys of a palette and the palette index of each.
+
+    As with a dict built in palette order, a repeated colour maps to its
+    last index.
+    """
+    def build():
+        keys = hash_colours(np.array(pal).reshape((-1, 3)))[::-1]
+        keys, first = np.unique(keys, return_index=True)
+        return keys, len(pal) - 1 - first
+    return palettes.get(pal, ("keys",), build)
+
+
+def colour_indices(image, pal):
+    """ Index in `pal` of every pixel colour of an RGB or L image, or of a
+    uint8 (h, w, 3) or (h, w) array.
+
+    Raises KeyError if the image contains a colour missing from `pal`.
+    """
+    keys, index = palette_keys(pal)
+    im_array = np.asarray(image)
+    if isinstance(image, np.ndarray):
+        mode = "L" if image.ndim == 2 else "RGB"
+    else:
+        mode = image.mode
+
+    if mode == "L":
+        # Look up the 256 grey levels once, then index by level
+        def build():
+            greys = hash_colours(np.repeat(np.arange(256)[:, None], 3, axis=1))
+            pos = np.minimum(np.searchsorted(keys, greys), len(keys) - 1)
+            return np.where(keys[pos] == greys, index[pos], -1)
+        grey_index = palettes.get(pal, ("grey",), build)
+        indices = grey_index[im_array]
+        missing = indices < 0
+        if missing.any():
+            raise KeyError(int(im_array[missing][0]) * 0x010101)
+        return indices
+
+    if mode != "RGB":
+        im_array = np.asarray(image.convert("RGB"))
+    pixel_keys = hash_colours(im_array)
+    pos = np.minimum(np.searchsorted(keys, pixel_keys), len(keys) - 1)
+    missing = keys[pos] != pixel_keys
+    if missing.any():
+        raise KeyError(int(pixel_keys[missing][0]))
+    return index[pos]
+
+
+def replace_colours(image, pal_a, pal_b, indexed=False):
+    """ Replace each colour of `pal_a` in an image by the same entry of
+    `pal_b`.
+
+    With `indexed`, the image (a "P" or "L" image, or an integer array)
+    already holds palette indices and is remapped without any colour lookup.
+    A "P" image is recoloured by swapping its palette, without touching its
+    pixels, and stays a "P" image.
+    """
+    if not isinstance(image, np.ndarray) and image.mode == "P":
+        return swap_palette(image, pal_a, pal_b, indexed)
+    return Image.fromarray(replace_colours_array(image, pal_a, pal_b,
+                                                 indexed))
+
+
+def swap_palette(image, pal_a, pal_b, indexed=False):
+    """ `replace_colours` for a "P" image, done on its palette alone.
+
+    Without `indexed`, each palette entry found in `pal_a` is replaced by
+    the same entry of `pal_b`; entries missing from `pal_a` are kept, or
+    raise KeyError if a pixel uses them. With `indexed`, the image indices
+    are positions in `pal_a` and `pal_b` becomes the palette.
+    """
+    to_array = palette_array(pal_b, np.uint8).reshape((-1, 3))
+    if indexed:
+        colours = to_array[:256]
+    else:
+        _, colours = image_indices(image)
+        keys, index = palette_keys(pal_a)
+        entry_keys = hash_colours(colours)
+        pos = np.minimum(np.searchsorted(keys, entry_keys), len(keys) - 1)
+        found = keys[pos] == entry_keys
+        used = np.array(image.histogram()[:len(colours)]) > 0
+        missing = used & ~found
+        if missing.any():
+            raise KeyError(int(entry_keys[missing][0]))
+        colours = colours.copy()
+        colours[found] = to_array[index[pos[found]]]
+    out = image.copy()
+    out.putpalette(colours.ravel().tolist())
+    return out
+
+
+def replace_colours_array(image, pal_a, pal_b, indexed=False, out=None):
+    """ `replace_colours` into a uint8 array `out`; `image` may also be an
+    array, e.g. a memory-mapped tile. """
+    to_array = palette_array(pal_b, np.uint8)
+    if indexed:
+        indices = np.asarray(image)
+    else:
+        indices = colour_indices(image, pal_a)
+    if out is None:
+        return to_array[indices]
+    np.take(to_array, indices, axis=0, out=out)
+    return out
 
 
 # Predefined palettes
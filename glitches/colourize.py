@@ -0,0 +1,92 @@
+import numpy as np
+from PIL import Image
+
+from glitches.cache import palettes, palette_array
+from glitches.colour import indexed_colours, indexed_image, mono_palette
+from glitches.dithering import (bayer_matrix, bayer_mono_luts, level_indices,
+                                floyd_steinberg_rows)
+
+
+# Fused quantize -> dither -> recolour pipeline.
+#
+# Pre-quantizing an RGB pixel to a grey palette only depends on r + g + b:
+# the squared distance to grey level l is r^2 + g^2 + b^2 - 2l(r + g + b)
+# + 3l^2. So the whole chain of quantize to grey levels, ordered dither to
+# fewer levels and replace levels by target colours collapses into one table
+# from r + g + b to target palette index per threshold phase.
+
+
+def sum_levels(levels):
+    """ Nearest grey level (as uint8) for each r + g + b from 0 to 765. """
+    levels = np.asarray(levels, dtype=np.double)
+    sums = np.arange(766, dtype=np.double)
+    cost = 3.0 * levels[None, :] ** 2 - 2.0 * levels[None, :] * sums[:, None]
+    return levels[np.argmin(cost, axis=1)].astype(np.uint8)
+
+
+def colourize_luts(pre_levels, monos, matrix):
+    """ Target palette index for each r + g + b at each matrix position. """
+    pre = palette_array(pre_levels, np.uint8)[:, 0]
+
+    def build():
+        grey = sum_levels(pre)
+        dithered = bayer_mono_luts(monos, matrix)[:, :, grey]
+        luts = level_indices(monos)[dithered]
+        luts.flags.writeable = False
+        return luts
+    return palettes.get(pre, ("colourize", len(monos), matrix), build)
+
+
+def colourize(image, out_palette, levels=None, dither="BAYER", matrix=4,
+              indexed=False):
+    """ Quantize, dither and recolour an image in a single pass.
+
+    Gives the same result as quantizing to `mono_palette(levels)` (by default
+    four times as many levels as `out_palette` has colours), dithering to
+    `mono_palette(len(out_palette))` and replacing those levels by
+    `out_palette`, without any intermediate full-size image. `dither` is
+    "BAYER" (with `matrix`) or "FS". With `indexed`, the palette indices are
+    never expanded to colours and a "P" image of `out_palette` is returned.
+    """
+    num_colours = len(out_palette)
+    if levels is None:
+        levels = num_colours * 4
+    pre_levels = mono_palette(levels)
+    monos = mono_palette(num_colours)
+    out_array = palette_array(out_palette, np.uint8)
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    im_array = np.asarray(image)
+    if indexed:
+        out = np.empty(im_array.shape[:2], dtype=np.uint8)
+        out_array = np.arange(len(indexed_colours(out_palette)),
+                              dtype=np.uint8)
+    else:
+        out = np.empty(im_array.shape, dtype=np.uint8)
+
+    if dither.upper() == "FS":
+        grey = sum_levels(palette_array(pre_levels, np.uint8)[:, 0])
+
+        def rows():
+            for row in im_array:
+                yield grey[row.sum(axis=1, dtype=np.uint16)]
+        for y, row in enumerate(floyd_steinberg_rows(rows(), monos, "MONO",
+                                                     indexed=True)):
+            out[y] = out_array[row]
+        return colourized(out, out_palette, indexed)
+
+    if bayer_matrix(matrix) is None:
+        raise ValueError("no %dx%d Bayer matrix" % (matrix, matrix))
+    luts = colourize_luts(pre_levels, monos, matrix)
+    for i in range(matrix):
+        for j in range(matrix):
+            sums = im_array[i::matrix, j::matrix].sum(axis=2, dtype=np.uint16)
+            out[i::matrix, j::matrix] = out_array[luts[i, j][sums]]
+    return colourized(out, out_palette, indexed)
+
+
+def colourized(out, out_palette, indexed):
+    if indexed:
+        return indexed_image(out, out_palette)
+    return Image.fromarray(out)
@@ -1,177 +1,395 @@
+import multiprocessing
+import threading
+
 import numpy as np
-from scipy.weave import inline
-from scipy.weave import converters
 from PIL import Image
 
+from glitches.backends import PRECISIONS, get_backend
+from glitches.cache import palettes, palette_array
+from glitches.colour import indexed_colours, indexed_image
+from glitches.kernels import FIXED_SHIFT, NO_INDICES
+from glitches.lut import METRICS, index_dtype, inverse_colormap, palette_grid
+
+
+def mono_levels(palette):
+    """ Grey levels of a monochrome palette as a 1D array.
+
+    Palettes of (l, l, l) tuples, as made by `mono_palette`, are reduced to
+    their first channel.
+    """
+    if palette is None:
+        return np.array([])
+
+    def build():
+        levels = np.array(palette, dtype=np.double)
+        if levels.ndim == 2:
+            levels = levels[:, 0].copy()
+        levels.flags.writeable = False
+        return levels
+    return palettes.get(palette, ("levels",), build)
+
+
+def mono_colours(palette):
+    """ uint8 (n, 3) colours that dithering to a monochrome palette gives,
+    in palette order. With no palette they are black and white. """
+    if palette is None:
+        return np.array([(0, 0, 0), (255, 255, 255)], dtype=np.uint8)
+    levels = mono_levels(palette).astype(np.uint8)
+    return np.repeat(levels[:, None], 3, axis=1)
+
+
+def level_indices(palette):
+    """ Palette index of each grey value that dithering to a monochrome
+    palette can produce, -1 for the others. """
+    colours = mono_colours(palette)
+    index = np.full(256, -1, dtype=np.intp)
+    index[colours[:, 0]] = np.arange(colours.shape[0])
+    return index
+
+
+# Floyd-Steinberg working precisions. "double" is the reference. "float32"
+# halves the working set; "int32" and "int16" hold channel values in fixed
+# point with FIXED_SHIFT fractional bits, and int16 quarters it. Every
+# precision is deterministic and the two fixed-point ones give the same
+# output. Error is carried at a different resolution though, and once a
+# single pixel rounds the other way the dither pattern around it shifts.
+# FS_TOLERANCES bounds the drift from the double result of the mean of
+# 16x16 blocks and of the whole image (channel values 0..255) for images
+# of 64x64 pixels or more; `scripts/benchmark.py --check-precision` checks
+# them. float32 rarely drifts at all, fixed point does so everywhere.
+
+FS_DTYPES = {"double": np.double, "float32": np.float32,
+             "int32": np.int32, "int16": np.int16}
+
+FS_TOLERANCES = {"float32": (12.0, 0.25),
+                 "int32": (12.0, 0.25),
+                 "int16": (12.0, 0.25)}
+
+
+def is_fixed(precision):
+    return np.dtype(FS_DTYPES[precision]).kind == "i"
 
-def floyd_steinberg_mono(image, palette=None):
-    """ Monochrome Floyd-Steinberg dithering """
+
+def fixed_palette(palette, mode):
+    """ Palette of a Floyd-Steinberg mode in fixed point, as intp. """
     if palette is None:
-        pal_array = np.array([])
-        nc = 0  # noqa
+        return np.array([], dtype=np.intp)
+
+    def build():
+        levels = mono_levels(palette) if mode == "MONO" \
+            else palette_array(palette)
+        fixed = np.round(levels * (1 << FIXED_SHIFT)).astype(np.intp)
+        fixed.flags.writeable = False
+        return fixed
+    return palettes.get(palette, ("fixed", mode), build)
+
+
+# RGB palettes of at least this many colours are searched through a
+# glitches.lut.PaletteGrid while dithering rather than scanned in full
+GRID_MIN_COLOURS = 12
+
+
+def grid_kernel(kernel, grid):
+    """ Bind a palette grid to a _grid kernel, giving a plain kernel. """
+    def run(im_array, pal_array, y0, y1, x0, x1, indices):
+        kernel(im_array, pal_array, y0, y1, x0, x1, indices,
+               grid.start, grid.items, grid.bits)
+    return run
+
+
+def fs_kernel(mode, palette, precision="double", metric="rgb"):
+    """ Kernel and palette array for a Floyd-Steinberg mode and precision,
+    from the active backend if it supports the precision.
+
+    With `metric` "lab", RGB palettes are matched through the Lab palette
+    grid, i.e. by the nearest colour in CIELAB to the centre of the 4x4x4
+    cell each value falls in. The metric does not apply to "MONO".
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision %r, expected one of %s" %
+                         (precision, ", ".join(PRECISIONS)))
+    if metric not in METRICS:
+        raise ValueError("unknown colour metric %r, expected one of %s" %
+                         (metric, ", ".join(METRICS)))
+    lab = mode != "MONO" and metric != "rgb"
+    backend = get_backend(precision=precision,
+                          kernel="fs_rgb_grid" if lab else None)
+    kernel = backend.fs(mode, precision)
+    if mode == "MONO":
+        pal_array = mono_levels(palette)
+    else:
+        pal_array = palette_array(palette)
+        indexed = backend.fs(mode, precision, grid=True)
+        if lab:
+            grid = palette_grid(pal_array, metric=metric)
+            kernel = grid_kernel(indexed, grid)
+        elif indexed is not None and len(pal_array) >= GRID_MIN_COLOURS:
+            kernel = grid_kernel(indexed, palette_grid(pal_array))
+    if is_fixed(precision):
+        pal_array = fixed_palette(palette, mode)
+    return kernel, pal_array
+
+
+def fs_array(array, precision="double"):
+    """ Working copy of a uint8 image array for a precision. """
+    im_array = np.array(array, dtype=FS_DTYPES[precision])
+    if is_fixed(precision):
+        im_array <<= FIXED_SHIFT
+    return im_array
+
+
+def fs_result(im_array, precision="double"):
+    """ Dithered working array back to uint8. """
+    if is_fixed(precision):
+        return (im_array >> FIXED_SHIFT).astype(np.uint8)
+    return im_array.astype(np.uint8)
+
+
+def fs_colours(mode, palette, precision="double"):
+    """ uint8 (n, 3) colours that Floyd-Steinberg output at `precision` is
+    made of, in palette order: each palette colour as the working array
+    holds it, converted back as by `fs_result`. """
+    if mode == "MONO" and palette is None:
+        return mono_colours(palette)
+    if is_fixed(precision):
+        pal = fixed_palette(palette, mode)
+    elif mode == "MONO":
+        pal = mono_levels(palette)
+    else:
+        pal = palette_array(palette)
+    colours = fs_result(np.asarray(pal, dtype=FS_DTYPES[precision]),
+                        precision)
+    if mode == "MONO":
+        colours = np.repeat(colours[:, None], 3, axis=1)
+    return colours
+
+
+def fs_index_plane(shape, mode, palette, precision="double", indexed=False):
+    """ uint8 (h, w) plane for the kernels to write the palette index of
+    each pixel of a working array of `shape` to, or NO_INDICES without
+    `indexed`. """
+    if not indexed:
+        return NO_INDICES
+    indexed_colours(fs_colours(mode, palette, precision))
+    return np.empty(shape[:2], dtype=np.uint8)
+
+
+def fs_image(im_array, indices, mode, palette, precision="double"):
+    """ Image of a dithered working array: a "P" image of
+    `fs_colours(mode, palette, precision)` when the kernels filled an index
+    plane, else an L or RGB image. """
+    if indices is NO_INDICES:
+        return Image.fromarray(fs_result(im_array, precision))
+    return indexed_image(indices, fs_colours(mode, palette, precision))
+
+
+def fs_rows(im_array, kernel, pal_array, y0, y1, x0=0, x1=None,
+            indices=NO_INDICES):
+    """ Dither rows y0..y1-1, columns x0..x1-1, of a working array in
+    place, writing the chosen palette indices to `indices` unless it is
+    NO_INDICES. """
+    if x1 is None:
+        x1 = im_array.shape[1]
+    kernel(im_array, pal_array, y0, y1, x0, x1, indices)
+
+
+def fs_wavefront(im_array, kernel, pal_array, workers, block=128,
+                 indices=NO_INDICES):
+    """ Dither a working array in place with rows spread over threads.
+
+    Row y is handled by thread y % workers, `block` columns at a time. A
+    block only starts once the row above has finished the next block, so
+    every pixel sees exactly the error it would in the serial order and
+    the result is bit-identical to `fs_rows`.
+    """
+    ny, nx = im_array.shape[:2]
+    block = max(block, 2)
+    nblocks = (nx + block - 1) // block
+    done = [0] * ny
+    failed = []
+    cond = threading.Condition()
+
+    def work(first):
+        try:
+            for y in range(first, ny, workers):
+                for j in range(nblocks):
+                    if y > 0:
+                        need = min(j + 2, nblocks)
+                        with cond:
+                            while done[y - 1] < need and not failed:
+                                cond.wait()
+                            if failed:
+                                return
+                    fs_rows(im_array, kernel, pal_array, y, y + 1,
+                            j * block, min(nx, (j + 1) * block), indices)
+                    with cond:
+                        done[y] = j + 1
+                        cond.notify_all()
+        except Exception as e:
+            with cond:
+                failed.append(e)
+                cond.notify_all()
+
+    threads = [threading.Thread(target=work, args=(k,))
+               for k in range(min(workers, ny))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failed:
+        raise failed[0]
+
+
+def fs_dither(im_array, kernel, pal_array, workers=1, indices=NO_INDICES):
+    """ Dither a whole working array in place. """
+    if workers > 1:
+        fs_wavefront(im_array, kernel, pal_array, workers, indices=indices)
     else:
-        pal_array = np.array(palette, dtype=np.double)
-        nc = pal_array.shape[0]  # noqa
-
-    im_array = np.array(image.convert('L'), dtype=np.double)
-    ny, nx = im_array.shape  # noqa
-
-    code = """
-    int col_idx;
-    double nearest, tmp, dist;
-    double quant_error, old_value, new_value;
-    for (int y = 0; y < ny; y++)
-    {
-        for (int x = 0; x < nx; x++)
-        {
-            // Clamp Colour
-            old_value = im_array(y, x);
-            old_value = old_value < 0 ? 0 : old_value;
-            old_value = old_value > 255 ? 255 : old_value;
-            im_array(y, x) = old_value;
-
-            if (nc == 0)
-            {
-                new_value = im_array(y, x) <= 128? 0 : 255;
-            }
-            else
-            {
-                col_idx = -1;
-                nearest = -1;
-
-
-                // Find Nearest Colour
-                for (int c=0; c<nc; c++)
-                {
-                    dist = 0;
-                    tmp = im_array(y, x) - pal_array(c);
-                    dist += tmp * tmp;
-                    if (col_idx == -1 || dist < nearest)
-                    {
-                        col_idx = c;
-                        nearest = dist;
-                    }
-                }
-                new_value = pal_array(col_idx);
-            }
-
-            // Set colour
-            old_value = im_array(y, x);
-            quant_error = old_value - new_value;
-            im_array(y, x) = new_value;
-
-            // Error diffusion
-            if (x < nx - 1)
-            {
-                im_array(y, x+1) += quant_error * (7.0/16.0);
-            }
-            if (y < ny - 1)
-            {
-                if (x > 0)
-                {
-                    im_array(y+1, x-1) += quant_error * (3.0/16.0);
-                }
-                im_array(y+1, x) += quant_error * (5.0/16.0);
-                if (x < nx - 1)
-                {
-                    im_array(y+1, x+1) += quant_error * (1.0/16.0);
-                }
-            }
-        }
-    }
+        fs_rows(im_array, kernel, pal_array, 0, im_array.shape[0],
+                indices=indices)
+
+
+def floyd_steinberg_mono(image, palette=None, workers=1, precision="double",
+                         indexed=False):
+    """ Monochrome Floyd-Steinberg dithering
+
+    With `workers` > 1 rows are dithered by that many threads in a
+    staggered wavefront, giving the same output as the serial path.
+    `precision` is one of PRECISIONS. With `indexed`, a "P" image is
+    returned instead of an L one.
+    """
+    kernel, pal_array = fs_kernel("MONO", palette, precision)
+    im_array = fs_array(image.convert('L'), precision)
+    indices = fs_index_plane(im_array.shape, "MONO", palette, precision,
+                             indexed)
+    fs_dither(im_array, kernel, pal_array, workers, indices)
+    return fs_image(im_array, indices, "MONO", palette, precision)
+
+
+def floyd_steinberg_rgb(image, pal, workers=1, precision="double",
+                        metric="rgb", indexed=False):
+    """ Floyd-Steinberg dithering using a palette.
+
+    With `workers` > 1 rows are dithered by that many threads in a
+    staggered wavefront, giving the same output as the serial path.
+    `precision` is one of PRECISIONS and `metric` one of METRICS. With
+    `indexed`, a "P" image is returned instead of an RGB one.
     """
-    inline(code, ['im_array', 'pal_array', 'nx', 'ny', 'nc'],
-           type_converters=converters.blitz)
-
-    return Image.fromarray(im_array.astype(np.uint8))
-
-
-def floyd_steinberg_rgb(image, pal):
-    """ Floyd-Steinberg dithering using a palette. """
-    pal_array = np.array(pal, dtype=np.double)
-    im_array = np.array(image.convert('RGB'), dtype=np.double)
-
-    ny, nx, _ = im_array.shape  # noqa
-    nc = pal_array.shape[0]  # noqa
-
-    code = """
-    int col_idx;
-    double nearest, tmp, dist;
-    double quant_error, old_value, new_value;
-    for (int y = 0; y < ny; y++)
-    {
-        for (int x = 0; x < nx; x++)
-        {
-            col_idx = -1;
-            nearest = -1;
-
-            // Clamp Colour
-            for (int band=0; band < 3; band++)
-            {
-                old_value = im_array(y, x, band);
-                old_value = old_value < 0 ? 0 : old_value;
-                old_value = old_value > 255 ? 255 : old_value;
-                im_array(y, x, band) = old_value;
-            }
-
-            // Find Nearest Colour
-            for (int c=0; c<nc; c++)
-            {
-                dist = 0;
-                for (int band=0; band < 3; band++)
-                {
-                    tmp = im_array(y, x, band) - pal_array(c, band);
-                    dist += tmp * tmp;
-                }
-                if (col_idx == -1 || dist < nearest)
-                {
-                    col_idx = c;
-                    nearest = dist;
-                }
-            }
-
-            // Set colour
-            for (int band = 0; band < 3; band++)
-            {
-                old_value = im_array(y, x, band);
-                new_value = pal_array(col_idx, band);
-                quant_error = old_value - new_value;
-                im_array(y, x, band) = new_value;
-
-                // Error diffusion
-                if (x < nx - 1)
-                {
-                    im_array(y, x+1, band) += quant_error * (7.0/16.0);
-                }
-                if (y < ny - 1)
-                {
-                    if (x > 0)
-                    {
-                        im_array(y+1, x-1, band) += quant_error * (3.0/16.0);
-                    }
-                    im_array(y+1, x, band) += quant_error * (5.0/16.0);
-                    if (x < nx - 1)
-                    {
-                        im_array(y+1, x+1, band) += quant_error * (1.0/16.0);
-                    }
-                }
-            }
-        }
-    }
+    kernel, pal_array = fs_kernel("RGB", pal, precision, metric)
+    im_array = fs_array(image.convert('RGB'), precision)
+    indices = fs_index_plane(im_array.shape, "RGB", pal, precision, indexed)
+    fs_dither(im_array, kernel, pal_array, workers, indices)
+    return fs_image(im_array, indices, "RGB", pal, precision)
+
+
+def image_rows(image, mode="RGB", strip=64):
+    """ Rows of an image as arrays, converted `strip` rows at a time. """
+    w, h = image.size
+    for y in range(0, h, strip):
+        block = image.crop((0, y, w, min(h, y + strip))).convert(mode)
+        for row in np.asarray(block):
+            yield row
+
+
+def floyd_steinberg_rows(rows, palette=None, mode="RGB", precision="double",
+                         metric="rgb", indexed=False):
+    """ Streaming Floyd-Steinberg dithering.
+
+    `rows` is an iterable of image rows, or strips of rows, as arrays of
+    shape (w,) or (h, w) for "MONO" and (w, 3) or (h, w, 3) for "RGB"; a
+    memory-mapped array or `image_rows(image)` both work. Finished rows are
+    yielded as uint8 arrays, one row behind the input. Only two rows are
+    held at a time and the output matches the whole-image functions. With
+    `indexed`, rows of indices into `fs_colours(mode, palette, precision)`
+    are yielded instead.
     """
-    inline(code, ['im_array', 'pal_array', 'nx', 'ny', 'nc'],
-           type_converters=converters.blitz)
+    kernel, pal_array = fs_kernel(mode, palette, precision, metric)
+    row_ndim = 1 if mode == "MONO" else 2
+    dtype = index_dtype(len(fs_colours(mode, palette, precision)))
+    indices = NO_INDICES
+
+    def result():
+        if indexed:
+            return indices[0].copy()
+        return fs_result(buf[0], precision)
+
+    buf = None
+    have = 0
+    for strip in rows:
+        strip = np.asarray(strip)
+        if strip.ndim == row_ndim:
+            strip = strip[None]
+        for row in strip:
+            if buf is None:
+                buf = np.empty((2,) + row.shape, dtype=FS_DTYPES[precision])
+                if indexed:
+                    indices = np.empty((1, row.shape[0]), dtype=dtype)
+            buf[have] = fs_array(row, precision)
+            if have == 0:
+                have = 1
+                continue
+
+            # Dither the top row into the bottom one, then shift up
+            fs_rows(buf, kernel, pal_array, 0, 1, indices=indices)
+            yield result()
+            buf[0] = buf[1]
+
+    if have:
+        fs_rows(buf[:1], kernel, pal_array, 0, 1, indices=indices)
+        yield result()
+
+
+def floyd_steinberg_stream(image, palette=None, mode="RGB", out=None,
+                           strip=64, precision="double", metric="rgb",
+                           indexed=False):
+    """ Floyd-Steinberg dithering with memory bounded by the image width.
+
+    Rows of `image` (a PIL image or an array) are dithered as they are read
+    and written to `out`, which may be a preallocated or memory-mapped uint8
+    array. Without `out`, an image is returned. With `indexed`, `out` is an
+    (h, w) array of palette indices and the image a "P" image.
+    """
+    if isinstance(image, np.ndarray):
+        rows = image
+        shape = image.shape
+    else:
+        mode_name = 'L' if mode == "MONO" else 'RGB'
+        rows = image_rows(image, mode_name, strip)
+        shape = (image.size[1], image.size[0])
+        if mode != "MONO":
+            shape += (3,)
+    dtype = np.uint8
+    if indexed:
+        shape = shape[:2]
+        colours = fs_colours(mode, palette, precision)
+        dtype = index_dtype(colours.shape[0])
+
+    if out is None:
+        result = np.empty(shape, dtype=dtype)
+    else:
+        result = out
+    for y, row in enumerate(floyd_steinberg_rows(rows, palette, mode,
+                                                 precision, metric,
+                                                 indexed)):
+        result[y] = row
 
-    return Image.fromarray(im_array.astype(np.uint8))
+    if out is None:
+        if indexed:
+            return indexed_image(result, colours)
+        return Image.fromarray(result)
+    return out
 
 
-def floyd_steinberg(image, palette=None, mode="RGB"):
+def floyd_steinberg(image, palette=None, mode="RGB", workers=1,
+                    precision="double", metric="rgb", indexed=False):
     if mode == "RGB":
         if palette is None:
             return None
-        return floyd_steinberg_rgb(image, palette)
+        return floyd_steinberg_rgb(image, palette, workers, precision,
+                                   metric, indexed)
     elif mode == "MONO":
-        return floyd_steinberg_mono(image, palette)
+        return floyd_steinberg_mono(image, palette, workers, precision,
+                                    indexed)
     else:
         return None
 
@@ -201,7 +419,8 @@ tm8x8 = [1, 49, 13, 61, 4, 52, 16, 64,
          43, 27, 39, 23, 42, 26, 38, 22]
 
 
-def bayer_mono(image, palette=None, matrix=4):
+def bayer_matrix(matrix):
+    """ Threshold matrix of the given size as a (matrix, matrix) array. """
     if matrix == 2:
         bayer = tm2x2
     elif matrix == 3:
@@ -212,80 +431,227 @@ def bayer_mono(image, palette=None, matrix=4):
         bayer = tm8x8
     else:
         return None
+    return np.array(bayer, dtype=np.double).reshape((matrix, matrix))
 
-    if palette is None:
-        pal_array = np.array([])
-        nc = 2  # noqa
-        bw = True  # noqa
+
+def bayer_offsets(matrix, gap):
+    """ Threshold offsets in (-gap / 2, gap / 2] for each matrix cell. """
+    bmatrix = bayer_matrix(matrix)
+    bmatrix *= gap
+    bmatrix /= matrix * matrix
+    bmatrix -= gap / 2.0
+    return bmatrix
+
+
+def bayer_mono_luts(palette, matrix):
+    """ Output level for every grey level at every matrix position.
+
+    Returns a (matrix, matrix, 256) uint8 table with the threshold offset,
+    clamping and nearest-level search all folded in.
+    """
+    levels = mono_levels(palette)
+
+    def build():
+        values = np.arange(256, dtype=np.double)
+        if palette is None:
+            offsets = bayer_offsets(matrix, 255.0)
+            values = values[None, None, :] + offsets[:, :, None]
+            luts = np.where(values < 128, 0, 255)
+        else:
+            offsets = bayer_offsets(matrix, 255.0 / (levels.shape[0] - 1))
+            values = values[None, None, :] + offsets[:, :, None]
+            values = np.clip(values, 0, 255)
+            dist = (values[..., None] - levels) ** 2
+            luts = levels[np.argmin(dist, axis=-1)]
+        luts = luts.astype(np.uint8)
+        luts.flags.writeable = False
+        return luts
+    return palettes.get(levels, ("bayer", matrix, palette is None), build)
+
+
+def apply_phase_luts(im_array, luts, out):
+    """ Look up each pixel in the table for its matrix position.
+
+    The threshold map is never tiled: each of the matrix * matrix phases is
+    a strided view of the image and is mapped with a single gather.
+    """
+    m = luts.shape[0]
+    for i in range(m):
+        for j in range(m):
+            out[i::m, j::m] = luts[i, j][im_array[i::m, j::m]]
+    return out
+
+
+def bayer_mono_array(im_array, palette=None, matrix=4, out=None,
+                     indexed=False):
+    """ Ordered dithering of a uint8 grey array into `out`. With `indexed`,
+    the result holds indices into `mono_colours(palette)`. """
+    luts = bayer_mono_luts(palette, matrix)
+    if indexed:
+        dtype = index_dtype(mono_colours(palette).shape[0])
+        luts = level_indices(palette)[luts].astype(dtype)
+    if out is None:
+        out = np.empty(im_array.shape, dtype=luts.dtype)
+    return apply_phase_luts(im_array, luts, out)
+
+
+def bayer_image(result, colours, indexed=False):
+    """ Image of a dithered array, "P" of `colours` with `indexed`. """
+    if indexed:
+        return indexed_image(result, colours)
+    return Image.fromarray(result)
+
+
+def bayer_mono(image, palette=None, matrix=4, workers=1, indexed=False):
+    """ Ordered dithering to black and white or to a grey palette.
+
+    With `workers` > 1 the image is dithered in bands by a process pool.
+    With `indexed`, a "P" image is returned instead of an L one.
+    """
+    if bayer_matrix(matrix) is None:
+        return None
+
+    im_array = np.asarray(image.convert('L'))
+    if workers > 1:
+        result = bayer_tiled(im_array, palette, matrix, workers, rgb=False,
+                             indexed=indexed)
     else:
-        pal_array = np.array(palette, dtype=np.double)
-        nc = pal_array.shape[0]  # noqa
-        bw = False  # noqa
+        result = bayer_mono_array(im_array, palette, matrix,
+                                  indexed=indexed)
+    return bayer_image(result, mono_colours(palette), indexed)
 
-    im_array = np.array(image.convert('L'), dtype=np.double)
 
-    # Calculate level gap
-    gap = 255.0 / (nc - 1)
+def bayer_rgb_luts(palette, matrix, spread=None):
+    """ Channel offset table for RGB ordered dithering.
 
-    # Setup bayer matrix
-    bmatrix = np.array(bayer, dtype=np.double).reshape((matrix, matrix))
-    bmatrix *= gap
-    bmatrix /= len(bayer)
-    bmatrix -= gap / 2.0
+    Returns a (matrix, matrix, 256) uint8 table mapping a channel value to
+    its clamped, threshold-shifted value. `spread` is the threshold range,
+    by default the gap between levels of an evenly spaced palette of the
+    same size.
+    """
+    pal_array = palette_array(palette)
+    if spread is None:
+        levels = max(2, int(round(pal_array.shape[0] ** (1.0 / 3.0))))
+        spread = 255.0 / (levels - 1)
+
+    def build():
+        offsets = bayer_offsets(matrix, spread)
+        values = np.arange(256, dtype=np.double)
+        values = values[None, None, :] + offsets[:, :, None]
+        luts = np.clip(values, 0, 255).astype(np.uint8)
+        luts.flags.writeable = False
+        return luts
+    return palettes.get(pal_array, ("bayer-rgb", matrix, spread), build)
+
+
+def bayer_rgb_array(im_array, palette, matrix=4, spread=None, out=None,
+                    metric="rgb", indexed=False):
+    """ Ordered dithering of a uint8 RGB array into `out`. With `indexed`,
+    the result is the (h, w) plane of palette indices. """
+    pal_array = palette_array(palette, np.uint8)
+    cmap = inverse_colormap(pal_array, metric=metric)
+    luts = bayer_rgb_luts(palette, matrix, spread)
+
+    if out is None:
+        if indexed:
+            out = np.empty(im_array.shape[:2], dtype=cmap.table.dtype)
+        else:
+            out = np.empty_like(im_array)
+    for i in range(matrix):
+        for j in range(matrix):
+            shifted = luts[i, j][im_array[i::matrix, j::matrix]]
+            indices = cmap.map(shifted)
+            if indexed:
+                out[i::matrix, j::matrix] = indices
+            else:
+                out[i::matrix, j::matrix] = pal_array[indices]
+    return out
+
+
+def bayer_rgb(image, palette, matrix=4, spread=None, workers=1, metric="rgb",
+              indexed=False):
+    """ Ordered dithering to an RGB palette.
+
+    With `workers` > 1 the image is dithered in bands by a process pool.
+    Thresholded pixels are matched to the palette by `metric`. With
+    `indexed`, a "P" image is returned instead of an RGB one.
+    """
+    if bayer_matrix(matrix) is None:
+        return None
+
+    im_array = np.asarray(image.convert('RGB'))
+    if workers > 1:
+        result = bayer_tiled(im_array, palette, matrix, workers, rgb=True,
+                             spread=spread, metric=metric, indexed=indexed)
+    else:
+        result = bayer_rgb_array(im_array, palette, matrix, spread,
+                                 metric=metric, indexed=indexed)
+    return bayer_image(result, palette, indexed)
+
+
+# Tiled ordered dithering. Bands start on a multiple of the matrix size, so
+# each band sees the same threshold phases as the whole image would and the
+# bands join without seams.
+
+band_state = {}
 
-    # Tile bayer matrix
-    bmatrix = np.tile(bmatrix, ((im_array.shape[0] / bmatrix.shape[0]) + 1,
-                                (im_array.shape[1] / bmatrix.shape[1]) + 1))
-    bmatrix = bmatrix[:im_array.shape[0], :im_array.shape[1]]
-
-    # Add Bayer Matrix
-    im_array += bmatrix
-
-    # Find nearest pixels
-    ny, nx = im_array.shape  # noqa
-
-    code = """
-    int col_idx;
-    double nearest, tmp, dist;
-    double col;
-    for (int y = 0; y < ny; y++)
-    {
-        for (int x = 0; x < nx; x++)
-        {
-            if (bw == true)
-            {
-                col = im_array(y, x);
-                col = col < 128 ? 0 : 255;
-            }
-            else
-            {
-                col = im_array(y, x);
-                col = col > 255? 255 : col;
-                col = col < 0? 0: col;
-
-                col_idx = -1;
-                nearest = -1;
-
-                // Find Nearest Colour
-                for (int c=0; c<nc; c++)
-                {
-                    dist = 0;
-                    tmp = col - pal_array(c);
-                    dist += tmp * tmp;
-                    if (col_idx == -1 || dist < nearest)
-                    {
-                        col_idx = c;
-                        nearest = dist;
-                    }
-                }
-                col = pal_array(col_idx);
-            }
-            im_array(y, x) = col;
-        }
-    }
+
+def bayer_band_init(src, dst, shape, palette, matrix, rgb, spread,
+                    metric="rgb", indexed=False):
+    dst_shape = shape[:2] if indexed else shape
+    band_state.update(
+        src=np.frombuffer(src, dtype=np.uint8).reshape(shape),
+        dst=np.frombuffer(dst, dtype=np.uint8).reshape(dst_shape),
+        palette=palette, matrix=matrix, rgb=rgb, spread=spread,
+        metric=metric, indexed=indexed)
+
+
+def bayer_band(rows):
+    y0, y1 = rows
+    st = band_state
+    src = st['src'][y0:y1]
+    dst = st['dst'][y0:y1]
+    if st['rgb']:
+        bayer_rgb_array(src, st['palette'], st['matrix'], st['spread'], dst,
+                        st['metric'], st['indexed'])
+    else:
+        bayer_mono_array(src, st['palette'], st['matrix'], dst,
+                         st['indexed'])
+    return y0
+
+
+def bayer_tiled(im_array, palette, matrix, workers, rgb=False, spread=None,
+                band=None, metric="rgb", indexed=False):
+    """ Ordered dithering of a uint8 array in bands over a process pool.
+
+    Input and output live in shared memory, so bands are neither pickled
+    nor copied on their way to and from the workers. With `indexed`, the
+    output is an (h, w) uint8 plane of palette indices.
     """
-    inline(code, ['im_array', 'pal_array', 'nx', 'ny', 'nc', 'bw'],
-           type_converters=converters.blitz)
-    return Image.fromarray(im_array.astype(np.uint8))
+    if indexed:
+        indexed_colours(palette if rgb else mono_colours(palette))
+    dst_shape = im_array.shape[:2] if indexed else im_array.shape
+    ny = im_array.shape[0]
+    if band is None:
+        band = max(1, ny // (workers * 4))
+    band = max(matrix, (band + matrix - 1) // matrix * matrix)
+    rows = [(y, min(ny, y + band)) for y in range(0, ny, band)]
+
+    src = multiprocessing.RawArray('B', im_array.size)
+    dst = multiprocessing.RawArray('B', int(np.prod(dst_shape)))
+    np.frombuffer(src, dtype=np.uint8)[:] = im_array.ravel()
+
+    if isinstance(palette, np.ndarray):
+        palette = palette.tolist()
+    pool = multiprocessing.Pool(workers, bayer_band_init,
+                                (src, dst, im_array.shape, palette, matrix,
+                                 rgb, spread, metric, indexed))
+    try:
+        pool.map(bayer_band, rows)
+    finally:
+        pool.close()
+        pool.join()
+    return np.frombuffer(dst, dtype=np.uint8).reshape(dst_shape)
+
 
 bayer = bayer_mono
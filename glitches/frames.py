@@ -0,0 +1,177 @@
+import glob
+import itertools
+import os
+
+from PIL import Image, GifImagePlugin
+
+
+# Frame sources
+
+
+def is_sequence(path):
+    """ True for frame patterns such as "in/%04d.png" or "in/*.png".
+
+    Existing files are never patterns, whatever characters they contain.
+    """
+    if os.path.exists(path):
+        return False
+    return "%" in path or any(c in path for c in "*?[")
+
+
+def sequence_paths(pattern):
+    """ Files of a numbered frame sequence, in frame order. """
+    if "%" in pattern:
+        paths = []
+        index = 0
+        while True:
+            path = pattern % index
+            if not os.path.exists(path):
+                # Sequences may start at 0 or 1
+                if index == 0:
+                    index = 1
+                    continue
+                break
+            paths.append(path)
+            index += 1
+        return paths
+    return sorted(glob.glob(pattern))
+
+
+def read_frames(source):
+    """ Lazily yield the frames of a clip as RGB images.
+
+    `source` is an animated image (GIF, APNG, ...), a printf-style numbered
+    pattern like "in/%04d.png" or a glob like "in/*.png". Only the current
+    frame is decoded at any time.
+    """
+    if is_sequence(source):
+        for path in sequence_paths(source):
+            image = Image.open(path)
+            yield image.convert("RGB")
+        return
+
+    image = Image.open(source)
+    index = 0
+    while True:
+        try:
+            image.seek(index)
+        except EOFError:
+            break
+        yield image.convert("RGB")
+        index += 1
+
+
+def frame_duration(source, default=100):
+    """ Frame duration in milliseconds of an animated image. """
+    if is_sequence(source):
+        return default
+    return Image.open(source).info.get("duration", default)
+
+
+# Frame sinks
+
+
+def write_sequence(frames, pattern):
+    """ Save each frame to a numbered file as soon as it arrives. """
+    outdir = os.path.dirname(pattern)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    count = 0
+    for index, frame in enumerate(frames):
+        frame.save(pattern % index)
+        count += 1
+    return count
+
+
+def write_gif(frames, fname, duration=100, loop=0):
+    """ Write an animated GIF one frame at a time.
+
+    All frames are mapped to the palette of the first frame, which suits
+    clips rendered with a fixed palette. "P" frames sharing that palette,
+    e.g. from the indexed dithering functions, are written as they are.
+    Raises ValueError, without creating `fname`, when there are no frames.
+    """
+    frames = iter(frames)
+    try:
+        first = next(frames)
+    except StopIteration:
+        raise ValueError("no frames to write to %s" % fname)
+    count = 0
+    palette = None
+    with open(fname, "wb") as fp:
+        for frame in itertools.chain((first,), frames):
+            if palette is None:
+                if frame.mode == "P":
+                    palette = frame.copy()
+                else:
+                    palette = frame.convert("RGB").quantize(256)
+                header = GifImagePlugin.getheader(palette, None,
+                                                  {"loop": loop})
+                if isinstance(header, tuple):
+                    header = header[0]
+                for chunk in header:
+                    fp.write(chunk)
+            if frame.mode == "P" and \
+                    frame.getpalette() == palette.getpalette():
+                # Encoding leaves state on the image, so write a copy
+                indexed = frame.copy()
+            else:
+                indexed = frame.convert("RGB").quantize(palette=palette)
+            for chunk in GifImagePlugin.getdata(indexed, duration=duration):
+                fp.write(chunk)
+            count += 1
+        fp.write(b";")
+    return count
+
+
+def write_image(frames, fname):
+    """ Save only the first frame, for formats that hold a single image. """
+    for frame in frames:
+        frame.save(fname)
+        return 1
+    raise ValueError("no frames to write to %s" % fname)
+
+
+def write_frames(frames, target, duration=100):
+    """ Write frames to a numbered pattern ("out/%04d.png") or a GIF.
+
+    Frames are consumed one by one and never collected, so memory stays
+    bounded by the frames in flight. Any other target gets the first frame
+    only. Returns the number of frames written.
+    """
+    if "%" in target:
+        return write_sequence(frames, target)
+    if os.path.splitext(target)[1].lower() == ".gif":
+        return write_gif(frames, target, duration)
+    return write_image(frames, target)
+
+
+# Pipelines
+
+
+def pipeline(frames, *stages):
+    """ Push each frame through the stages in turn, one frame at a time.
+
+    Each stage is a function taking and returning an image. Stages that need
+    clip-wide state (such as a palette) should build it once and close over
+    it, see `clip_stage`.
+    """
+    for frame in frames:
+        for stage in stages:
+            frame = stage(frame)
+        yield frame
+
+
+def clip_stage(setup):
+    """ Stage whose state is built from the first frame of the clip.
+
+    `setup(frame)` is called once and returns the function applied to every
+    frame, including the first.
+    """
+    state = []
+
+    def stage(frame):
+        if not state:
+            state.append(setup(frame))
+        return state[0](frame)
+    return stage
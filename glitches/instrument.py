@@ -0,0 +1,128 @@
+import json
+import time
+import tracemalloc
+
+
+# Pipeline stage instrumentation. Pipelines wrap each stage in `stage(...)`;
+# every finished stage is passed to the subscribed callbacks as a dict:
+#
+#   {"stage": "quantize", "wall": 0.012, "cpu": 0.011,
+#    "peak_bytes": 1048576, "pixels": 49152, ...}
+#
+# peak_bytes is only measured while tracemalloc is tracing, otherwise None.
+# Stages may nest, e.g. library functions that open their own stages inside
+# a caller's: the peak of an inner stage counts towards the outer one.
+
+subscribers = []
+
+
+def subscribe(callback):
+    """ Call `callback(event)` for every finished stage. """
+    subscribers.append(callback)
+    return callback
+
+
+def unsubscribe(callback):
+    if callback in subscribers:
+        subscribers.remove(callback)
+
+
+def emit(event):
+    for callback in list(subscribers):
+        callback(event)
+
+
+def start_tracing():
+    """ Start tracing allocations so stages report peak_bytes. """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def image_pixels(image):
+    return image.size[0] * image.size[1]
+
+
+# Stages currently open, innermost last
+open_stages = []
+
+
+class Stage(object):
+    """ Context manager timing one pipeline stage.
+
+    `pixels` and any extra fields may also be set on the stage inside the
+    with block, once the output size is known.
+    """
+    def __init__(self, name, pixels=None, **info):
+        self.name = name
+        self.pixels = pixels
+        self.info = info
+
+    def __enter__(self):
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            self.mem_start = current
+            self.peak = current
+            if hasattr(tracemalloc, "reset_peak"):
+                # Hand the peak so far to the enclosing stage before the
+                # global peak restarts from here
+                if open_stages:
+                    open_stages[-1].fold_peak(peak)
+                tracemalloc.reset_peak()
+        open_stages.append(self)
+        self.cpu_start = time.process_time()
+        self.wall_start = time.time()
+        return self
+
+    def fold_peak(self, peak):
+        """ Count a traced memory peak reached while this stage is open. """
+        if self.tracing:
+            self.peak = max(self.peak, peak)
+
+    def __exit__(self, exc_type, exc, tb):
+        event = {"stage": self.name,
+                 "wall": time.time() - self.wall_start,
+                 "cpu": time.process_time() - self.cpu_start,
+                 "peak_bytes": None,
+                 "pixels": self.pixels}
+        if self in open_stages:
+            open_stages.remove(self)
+        if self.tracing:
+            self.fold_peak(tracemalloc.get_traced_memory()[1])
+            event["peak_bytes"] = max(0, self.peak - self.mem_start)
+            if open_stages:
+                open_stages[-1].fold_peak(self.peak)
+        if exc_type is not None:
+            event["error"] = exc_type.__name__
+        event.update(self.info)
+        emit(event)
+        return False
+
+
+def stage(name, pixels=None, **info):
+    return Stage(name, pixels, **info)
+
+
+class Recorder(object):
+    """ Subscriber collecting events, e.g. to attach to a batch result. """
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def __enter__(self):
+        subscribe(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        unsubscribe(self)
+        return False
+
+
+def json_writer(stream):
+    """ Subscriber writing each event to `stream` as a line of JSON. """
+    def write(event):
+        stream.write(json.dumps(event, sort_keys=True) + "\n")
+        stream.flush()
+    return write
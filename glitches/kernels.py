@@ -0,0 +1,369 @@
+import numpy as np
+
+
+# Floyd-Steinberg kernels in plain Python. They are run as they are by the
+# "python" backend and compiled by the "numba" backend, so they stick to
+# loops over arrays and scalars. Both dither columns x0..x1-1 of rows
+# y0..y1-1 of im_array in place, diffusing error into the following row
+# when im_array has one, and match the weave kernels operation for
+# operation. Each pixel's palette index is also written to `indices`, an
+# integer array of the image's height and width, unless it is empty
+# (see NO_INDICES).
+#
+# The float kernels also run on float32 arrays: values are widened to
+# double as they are read and rounded once as they are stored, so every
+# backend gives the same float32 result. The fixed-point kernels work on
+# integer arrays holding 16 times the channel value (FIXED_SHIFT fractional
+# bits) and split the error with integer weights, giving the remainder to
+# the last term so no error is lost.
+
+FIXED_SHIFT = 4
+FIXED_MAX = 255 << FIXED_SHIFT
+
+# Index plane for callers that only want colours
+NO_INDICES = np.empty((0, 0), dtype=np.uint8)
+
+
+def fs_mono(im_array, pal_array, y0, y1, x0, x1, indices):
+    ny = im_array.shape[0]
+    nx = im_array.shape[1]
+    nc = pal_array.shape[0]
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            # Clamp Colour
+            old_value = float(im_array[y, x])
+            if old_value < 0:
+                old_value = 0.0
+            if old_value > 255:
+                old_value = 255.0
+            im_array[y, x] = old_value
+
+            if nc == 0:
+                if old_value <= 128:
+                    col_idx = 0
+                    new_value = 0.0
+                else:
+                    col_idx = 1
+                    new_value = 255.0
+            else:
+                # Find Nearest Colour
+                col_idx = 0
+                tmp = old_value - pal_array[0]
+                nearest = tmp * tmp
+                for c in range(1, nc):
+                    tmp = old_value - pal_array[c]
+                    dist = tmp * tmp
+                    if dist < nearest:
+                        col_idx = c
+                        nearest = dist
+                new_value = pal_array[col_idx]
+
+            if indices.shape[0] > 0:
+                indices[y, x] = col_idx
+
+            # Set colour
+            quant_error = old_value - new_value
+            im_array[y, x] = new_value
+
+            # Error diffusion
+            if x < nx - 1:
+                im_array[y, x + 1] = \
+                    float(im_array[y, x + 1]) + quant_error * (7.0 / 16.0)
+            if y < ny - 1:
+                if x > 0:
+                    im_array[y + 1, x - 1] = float(im_array[y + 1, x - 1]) \
+                        + quant_error * (3.0 / 16.0)
+                im_array[y + 1, x] = \
+                    float(im_array[y + 1, x]) + quant_error * (5.0 / 16.0)
+                if x < nx - 1:
+                    im_array[y + 1, x + 1] = float(im_array[y + 1, x + 1]) \
+                        + quant_error * (1.0 / 16.0)
+
+
+def fs_rgb(im_array, pal_array, y0, y1, x0, x1, indices):
+    ny = im_array.shape[0]
+    nx = im_array.shape[1]
+    nc = pal_array.shape[0]
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            # Clamp Colour
+            for band in range(3):
+                old_value = float(im_array[y, x, band])
+                if old_value < 0:
+                    old_value = 0.0
+                if old_value > 255:
+                    old_value = 255.0
+                im_array[y, x, band] = old_value
+
+            # Find Nearest Colour
+            col_idx = -1
+            nearest = -1.0
+            for c in range(nc):
+                dist = 0.0
+                for band in range(3):
+                    tmp = float(im_array[y, x, band]) - pal_array[c, band]
+                    dist += tmp * tmp
+                if col_idx == -1 or dist < nearest:
+                    col_idx = c
+                    nearest = dist
+
+            if indices.shape[0] > 0:
+                indices[y, x] = col_idx
+
+            # Set colour
+            for band in range(3):
+                old_value = float(im_array[y, x, band])
+                new_value = pal_array[col_idx, band]
+                quant_error = old_value - new_value
+                im_array[y, x, band] = new_value
+
+                # Error diffusion
+                if x < nx - 1:
+                    im_array[y, x + 1, band] = \
+                        float(im_array[y, x + 1, band]) + \
+                        quant_error * (7.0 / 16.0)
+                if y < ny - 1:
+                    if x > 0:
+                        im_array[y + 1, x - 1, band] = \
+                            float(im_array[y + 1, x - 1, band]) + \
+                            quant_error * (3.0 / 16.0)
+                    im_array[y + 1, x, band] = \
+                        float(im_array[y + 1, x, band]) + \
+                        quant_error * (5.0 / 16.0)
+                    if x < nx - 1:
+                        im_array[y + 1, x + 1, band] = \
+                            float(im_array[y + 1, x + 1, band]) + \
+                            quant_error * (1.0 / 16.0)
+
+
+def fs_mono_fixed(im_array, pal_array, y0, y1, x0, x1, indices):
+    ny = im_array.shape[0]
+    nx = im_array.shape[1]
+    nc = pal_array.shape[0]
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            # Clamp Colour
+            old_value = int(im_array[y, x])
+            if old_value < 0:
+                old_value = 0
+            if old_value > FIXED_MAX:
+                old_value = FIXED_MAX
+
+            if nc == 0:
+                if old_value <= 128 << FIXED_SHIFT:
+                    col_idx = 0
+                    new_value = 0
+                else:
+                    col_idx = 1
+                    new_value = FIXED_MAX
+            else:
+                # Find Nearest Colour
+                col_idx = 0
+                tmp = old_value - pal_array[0]
+                nearest = tmp * tmp
+                for c in range(1, nc):
+                    tmp = old_value - pal_array[c]
+                    dist = tmp * tmp
+                    if dist < nearest:
+                        col_idx = c
+                        nearest = dist
+                new_value = int(pal_array[col_idx])
+
+            if indices.shape[0] > 0:
+                indices[y, x] = col_idx
+
+            # Set colour
+            quant_error = old_value - new_value
+            im_array[y, x] = new_value
+
+            # Error diffusion
+            e7 = (quant_error * 7) >> FIXED_SHIFT
+            e3 = (quant_error * 3) >> FIXED_SHIFT
+            e5 = (quant_error * 5) >> FIXED_SHIFT
+            e1 = quant_error - e7 - e3 - e5
+            if x < nx - 1:
+                im_array[y, x + 1] = int(im_array[y, x + 1]) + e7
+            if y < ny - 1:
+                if x > 0:
+                    im_array[y + 1, x - 1] = int(im_array[y + 1, x - 1]) + e3
+                im_array[y + 1, x] = int(im_array[y + 1, x]) + e5
+                if x < nx - 1:
+                    im_array[y + 1, x + 1] = int(im_array[y + 1, x + 1]) + e1
+
+
+def fs_rgb_fixed(im_array, pal_array, y0, y1, x0, x1, indices):
+    ny = im_array.shape[0]
+    nx = im_array.shape[1]
+    nc = pal_array.shape[0]
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            # Clamp Colour
+            for band in range(3):
+                old_value = int(im_array[y, x, band])
+                if old_value < 0:
+                    old_value = 0
+                if old_value > FIXED_MAX:
+                    old_value = FIXED_MAX
+                im_array[y, x, band] = old_value
+
+            # Find Nearest Colour
+            col_idx = -1
+            nearest = -1
+            for c in range(nc):
+                dist = 0
+                for band in range(3):
+                    tmp = int(im_array[y, x, band]) - int(pal_array[c, band])
+                    dist += tmp * tmp
+                if col_idx == -1 or dist < nearest:
+                    col_idx = c
+                    nearest = dist
+
+            if indices.shape[0] > 0:
+                indices[y, x] = col_idx
+
+            # Set colour
+            for band in range(3):
+                old_value = int(im_array[y, x, band])
+                new_value = int(pal_array[col_idx, band])
+                quant_error = old_value - new_value
+                im_array[y, x, band] = new_value
+
+                # Error diffusion
+                e7 = (quant_error * 7) >> FIXED_SHIFT
+                e3 = (quant_error * 3) >> FIXED_SHIFT
+                e5 = (quant_error * 5) >> FIXED_SHIFT
+                e1 = quant_error - e7 - e3 - e5
+                if x < nx - 1:
+                    im_array[y, x + 1, band] = \
+                        int(im_array[y, x + 1, band]) + e7
+                if y < ny - 1:
+                    if x > 0:
+                        im_array[y + 1, x - 1, band] = \
+                            int(im_array[y + 1, x - 1, band]) + e3
+                    im_array[y + 1, x, band] = \
+                        int(im_array[y + 1, x, band]) + e5
+                    if x < nx - 1:
+                        im_array[y + 1, x + 1, band] = \
+                            int(im_array[y + 1, x + 1, band]) + e1
+
+
+def fs_rgb_grid(im_array, pal_array, y0, y1, x0, x1, indices, start, items,
+                bits):
+    ny = im_array.shape[0]
+    nx = im_array.shape[1]
+    shift = 8 - bits
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            # Clamp Colour
+            for band in range(3):
+                old_value = float(im_array[y, x, band])
+                if old_value < 0:
+                    old_value = 0.0
+                if old_value > 255:
+                    old_value = 255.0
+                im_array[y, x, band] = old_value
+
+            # Find Nearest Colour among the candidates of the grid cell
+            cell = (int(im_array[y, x, 0]) >> shift) << (2 * bits)
+            cell |= (int(im_array[y, x, 1]) >> shift) << bits
+            cell |= int(im_array[y, x, 2]) >> shift
+            col_idx = -1
+            nearest = -1.0
+            for i in range(start[cell], start[cell + 1]):
+                c = items[i]
+                dist = 0.0
+                for band in range(3):
+                    tmp = float(im_array[y, x, band]) - pal_array[c, band]
+                    dist += tmp * tmp
+                if col_idx == -1 or dist < nearest:
+                    col_idx = c
+                    nearest = dist
+
+            if indices.shape[0] > 0:
+                indices[y, x] = col_idx
+
+            # Set colour
+            for band in range(3):
+                old_value = float(im_array[y, x, band])
+                new_value = pal_array[col_idx, band]
+                quant_error = old_value - new_value
+                im_array[y, x, band] = new_value
+
+                # Error diffusion
+                if x < nx - 1:
+                    im_array[y, x + 1, band] = \
+                        float(im_array[y, x + 1, band]) + \
+                        quant_error * (7.0 / 16.0)
+                if y < ny - 1:
+                    if x > 0:
+                        im_array[y + 1, x - 1, band] = \
+                            float(im_array[y + 1, x - 1, band]) + \
+                            quant_error * (3.0 / 16.0)
+                    im_array[y + 1, x, band] = \
+                        float(im_array[y + 1, x, band]) + \
+                        quant_error * (5.0 / 16.0)
+                    if x < nx - 1:
+                        im_array[y + 1, x + 1, band] = \
+                            float(im_array[y + 1, x + 1, band]) + \
+                            quant_error * (1.0 / 16.0)
+
+
+def fs_rgb_fixed_grid(im_array, pal_array, y0, y1, x0, x1, indices, start,
+                      items, bits):
+    ny = im_array.shape[0]
+    nx = im_array.shape[1]
+    shift = FIXED_SHIFT + 8 - bits
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            # Clamp Colour
+            for band in range(3):
+                old_value = int(im_array[y, x, band])
+                if old_value < 0:
+                    old_value = 0
+                if old_value > FIXED_MAX:
+                    old_value = FIXED_MAX
+                im_array[y, x, band] = old_value
+
+            # Find Nearest Colour among the candidates of the grid cell
+            cell = (int(im_array[y, x, 0]) >> shift) << (2 * bits)
+            cell |= (int(im_array[y, x, 1]) >> shift) << bits
+            cell |= int(im_array[y, x, 2]) >> shift
+            col_idx = -1
+            nearest = -1
+            for i in range(start[cell], start[cell + 1]):
+                c = items[i]
+                dist = 0
+                for band in range(3):
+                    tmp = int(im_array[y, x, band]) - int(pal_array[c, band])
+                    dist += tmp * tmp
+                if col_idx == -1 or dist < nearest:
+                    col_idx = c
+                    nearest = dist
+
+            if indices.shape[0] > 0:
+                indices[y, x] = col_idx
+
+            # Set colour
+            for band in range(3):
+                old_value = int(im_array[y, x, band])
+                new_value = int(pal_array[col_idx, band])
+                quant_error = old_value - new_value
+                im_array[y, x, band] = new_value
+
+                # Error diffusion
+                e7 = (quant_error * 7) >> FIXED_SHIFT
+                e3 = (quant_error * 3) >> FIXED_SHIFT
+                e5 = (quant_error * 5) >> FIXED_SHIFT
+                e1 = quant_error - e7 - e3 - e5
+                if x < nx - 1:
+                    im_array[y, x + 1, band] = \
+                        int(im_array[y, x + 1, band]) + e7
+                if y < ny - 1:
+                    if x > 0:
+                        im_array[y + 1, x - 1, band] = \
+                            int(im_array[y + 1, x - 1, band]) + e3
+                    im_array[y + 1, x, band] = \
+                        int(im_array[y + 1, x, band]) + e5
+                    if x < nx - 1:
+                        im_array[y + 1, x + 1, band] = \
+                            int(im_array[y + 1, x + 1, band]) + e1
@@ -0,0 +1,370 @@
+import numpy as np
+
+from glitches.cache import palettes
+
+
+# Colour space code
+
+# Colour metrics: distances between colours are measured in "rgb" or in
+# CIELAB ("lab", D65 white, i.e. the CIE76 delta E)
+METRICS = ("rgb", "lab")
+
+# sRGB (D65) to CIE XYZ
+SRGB_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                     [0.2126729, 0.7151522, 0.0721750],
+                     [0.0193339, 0.1191920, 0.9503041]])
+D65_WHITE = SRGB_XYZ.sum(axis=1)
+
+
+def srgb_linear(values):
+    """ Linear light of sRGB channel values in 0..255. """
+    v = np.asarray(values, dtype=np.double) / 255.0
+    return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+
+# Linear light of each uint8 channel value
+SRGB_LINEAR = srgb_linear(np.arange(256))
+SRGB_LINEAR.flags.writeable = False
+
+
+def rgb_to_lab(colours):
+    """ CIELAB coordinates of an (..., 3) array of RGB colours.
+
+    uint8 colours are linearized through a table, others (e.g. cell
+    centres) by the sRGB formula.
+    """
+    colours = np.asarray(colours)
+    if colours.dtype == np.uint8:
+        linear = SRGB_LINEAR[colours]
+    else:
+        linear = srgb_linear(colours)
+    xyz = np.dot(linear, SRGB_XYZ.T) / D65_WHITE
+
+    edge = (6.0 / 29.0) ** 3
+    f = np.where(xyz > edge, np.cbrt(np.maximum(xyz, edge)),
+                 xyz / (3.0 * (6.0 / 29.0) ** 2) + 4.0 / 29.0)
+    lab = np.empty(f.shape)
+    lab[..., 0] = 116.0 * f[..., 1] - 16.0
+    lab[..., 1] = 500.0 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200.0 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def metric_space(metric):
+    """ Function taking RGB colours to the space a metric measures in. """
+    if metric == "rgb":
+        return lambda colours: np.asarray(colours, dtype=np.double)
+    elif metric == "lab":
+        return rgb_to_lab
+    raise ValueError("unknown colour metric %r, expected one of %s" %
+                     (metric, ", ".join(METRICS)))
+
+
+# End of colour space code
+
+
+# Inverse colormap code
+
+# Cell spreads by (bits, metric); they do not depend on the palette
+spreads = {}
+
+
+def cell_spread(bits, metric, chunk=4096):
+    """ Largest distance, in a metric's space, from the centre of each cell
+    of an inverse colormap to a corner pixel of that cell. """
+    key = (bits, metric)
+    if key not in spreads:
+        space = metric_space(metric)
+        shift = 8 - bits
+        half = ((1 << shift) - 1) / 2.0
+        centres = (np.arange(1 << bits) << shift) + half
+        r, g, b = np.meshgrid(centres, centres, centres, indexing='ij')
+        grid = np.column_stack((r.ravel(), g.ravel(), b.ravel()))
+        corners = np.array([[i, j, k] for i in (-half, half)
+                            for j in (-half, half) for k in (-half, half)])
+
+        spread = np.empty(grid.shape[0])
+        for i in range(0, grid.shape[0], chunk):
+            block = grid[i:i + chunk]
+            mid = space(block)
+            ends = space(block[:, None, :] + corners[None, :, :])
+            spread[i:i + chunk] = np.sqrt(
+                ((ends - mid[:, None, :]) ** 2).sum(axis=2)).max(axis=1)
+        spread.flags.writeable = False
+        spreads[key] = spread
+    return spreads[key]
+
+
+def nearest(colours, pal_array, chunk=65536, metric="rgb"):
+    """ Brute-force nearest palette index for an (N, 3) array of colours. """
+    space = metric_space(metric)
+    colours = np.asarray(colours).reshape((-1, 3))
+    pal = space(np.asarray(pal_array, dtype=np.double))
+    out = np.empty(colours.shape[0], dtype=np.intp)
+    for i in range(0, colours.shape[0], chunk):
+        block = space(colours[i:i + chunk])
+        dist = ((block[:, None, :] - pal[None, :, :]) ** 2).sum(axis=2)
+        out[i:i + chunk] = np.argmin(dist, axis=1)
+    return out
+
+
+def index_dtype(num_colours):
+    """ Smallest unsigned integer type able to index a palette. """
+    if num_colours <= 256:
+        return np.uint8
+    elif num_colours <= 65536:
+        return np.uint16
+    return np.uint32
+
+
+class InverseColormap(object):
+    """ Nearest-colour lookup table for a fixed RGB palette.
+
+    The RGB cube is divided into cells of 2**(8 - bits) values per channel
+    and the nearest palette entry is found once for the centre of each cell.
+    Cells in which every pixel is guaranteed to share that nearest entry are
+    resolved by the table alone; the remaining cells keep a short list of
+    candidate entries which are searched exactly. For "rgb" the reach of a
+    cell is bounded exactly, so `map` always returns the same indices as a
+    brute-force search (`nearest`; ties go to the lowest index).
+
+    With `metric` "lab", distances are measured in CIELAB. The palette and
+    the cell centres are converted once, so only pixels in ambiguous cells
+    are ever converted. A cell's reach in Lab is taken from its corners
+    with a 25% margin for the curvature of the conversion. That margin is
+    a heuristic, not a proven bound: it has matched a brute-force search
+    on the palettes tried, over all 2**24 colours, but a pixel could in
+    principle be given a candidate list missing its nearest entry.
+    """
+    def __init__(self, palette, bits=6, chunk=4096, metric="rgb"):
+        self.palette = np.array(palette, dtype=np.double).reshape((-1, 3))
+        self.bits = bits
+        self.shift = 8 - bits
+        self.metric = metric
+        self.space = metric_space(metric)
+        self.points = self.space(self.palette)
+
+        nc = self.palette.shape[0]
+        side = 1 << bits
+        cell = 1 << self.shift
+
+        # Cell centres in r, g, b order
+        centres = (np.arange(side) << self.shift) + (cell - 1) / 2.0
+        r, g, b = np.meshgrid(centres, centres, centres, indexing='ij')
+        grid = np.column_stack((r.ravel(), g.ravel(), b.ravel()))
+
+        # Worst-case distance from a cell centre to a pixel in that cell
+        # (padded to absorb rounding in the distance expansion below)
+        if metric == "rgb":
+            reach = np.full(grid.shape[0],
+                            2.0 * np.sqrt(3.0) * (cell - 1) / 2.0 + 1e-3)
+        else:
+            reach = 2.0 * 1.25 * cell_spread(bits, metric) + 1e-3
+
+        pal_sq = (self.points ** 2).sum(axis=1)
+        table = np.empty(grid.shape[0], dtype=index_dtype(nc))
+        counts = np.ones(grid.shape[0], dtype=np.intp)
+        lists = []
+        for i in range(0, grid.shape[0], chunk):
+            block = self.space(grid[i:i + chunk])
+            dist = ((block ** 2).sum(axis=1)[:, None] + pal_sq[None, :] -
+                    2.0 * np.dot(block, self.points.T))
+            dist = np.sqrt(np.maximum(dist, 0.0))
+            best = np.argmin(dist, axis=1)
+            table[i:i + chunk] = best
+
+            # Entries that could be nearest for some pixel in the cell
+            nearest_dist = dist[np.arange(block.shape[0]), best]
+            close = dist <= (nearest_dist + reach[i:i + chunk])[:, None]
+            count = close.sum(axis=1)
+            counts[i:i + chunk] = count
+
+            rows = np.flatnonzero(count > 1)
+            if rows.size:
+                order = np.argsort(~close[rows], axis=1, kind='mergesort')
+                lists.append((i + rows, order[:, :count[rows].max()]))
+
+        self.table = table
+        self.exact = counts == 1
+
+        # Candidate lists for ambiguous cells, in ascending palette order,
+        # padded with their first candidate
+        ambiguous = np.flatnonzero(~self.exact)
+        width = max([order.shape[1] for _, order in lists] or [1])
+        self.slots = np.full(grid.shape[0], -1, dtype=np.intp)
+        self.slots[ambiguous] = np.arange(ambiguous.size)
+        self.candidates = np.empty((ambiguous.size, width),
+                                   dtype=index_dtype(nc))
+        for rows, order in lists:
+            cand = np.repeat(order[:, :1], width, axis=1)
+            pad = np.arange(order.shape[1])[None, :] < counts[rows][:, None]
+            cand[:, :order.shape[1]] = np.where(pad, order, order[:, :1])
+            self.candidates[self.slots[rows]] = cand
+        self.widths = counts[ambiguous]
+
+    def width_classes(self):
+        """ Candidate list lengths that ambiguous cells are searched at. """
+        width = self.candidates.shape[1]
+        classes = [w for w in (2, 4, 8) if w < width]
+        return classes + [width]
+
+    @property
+    def nbytes(self):
+        return (self.palette.nbytes + self.points.nbytes +
+                self.table.nbytes + self.exact.nbytes + self.slots.nbytes +
+                self.candidates.nbytes)
+
+    def cells(self, pixels):
+        """ Table cell for each pixel of a uint8 (..., 3) array. """
+        pixels = np.asarray(pixels)
+        s = self.shift
+        b = self.bits
+        cell = (pixels[..., 0] >> s).astype(np.intp) << (2 * b)
+        cell |= (pixels[..., 1] >> s).astype(np.intp) << b
+        cell |= pixels[..., 2] >> s
+        return cell
+
+    def map(self, pixels, chunk=65536):
+        """ Nearest palette index for each pixel of a uint8 (..., 3) array. """
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        cell = self.cells(pixels)
+        indices = self.table[cell]
+
+        # Refine pixels in ambiguous cells against their candidates
+        todo = np.flatnonzero(~self.exact[cell])
+        if todo.size:
+            flat_pixels = pixels.reshape((-1, 3))
+            flat_cells = cell.ravel()
+            flat_indices = indices.reshape(-1)
+            for i in range(0, todo.size, chunk):
+                sel = todo[i:i + chunk]
+                slots = self.slots[flat_cells[sel]]
+                points = self.space(flat_pixels[sel])
+
+                # Search short candidate lists without their padding
+                widths = self.widths[slots]
+                lo = 0
+                for hi in self.width_classes():
+                    group = np.flatnonzero((widths > lo) & (widths <= hi))
+                    lo = hi
+                    if not group.size:
+                        continue
+                    cand = self.candidates[slots[group], :hi]
+                    cols = self.points[cand]
+                    diff = cols - points[group][:, None, :]
+                    dist = (diff ** 2).sum(axis=2)
+                    best = np.argmin(dist, axis=1)
+                    flat_indices[sel[group]] = cand[np.arange(group.size),
+                                                    best]
+        return indices
+
+
+def inverse_colormap(palette, bits=6, metric="rgb"):
+    """ Cached InverseColormap for a palette. """
+    if metric == "rgb":
+        kind = ("colormap", bits)
+    else:
+        kind = ("colormap", bits, metric)
+    return palettes.get(palette, kind,
+                        lambda: InverseColormap(palette, bits, metric=metric))
+
+
+# End of inverse colormap code
+
+
+# Palette grid code
+
+
+class PaletteGrid(object):
+    """ Candidate lists for nearest-colour searches on arbitrary values.
+
+    The RGB cube is divided into 2**bits cells per channel and each cell
+    lists, in ascending palette order, every entry that could be nearest to
+    some point of the cell, including non-integer ones. A search only has
+    to scan the list of the cell a value falls in and returns the same
+    index as a full scan, so kernels can use it on values that are not
+    known in advance, as in error diffusion.
+
+    The lists are stored flat: the entries of cell i are
+    `items[start[i]:start[i + 1]]`.
+    """
+    def __init__(self, palette, bits=4, pad=0.25, chunk=256):
+        self.palette = np.array(palette, dtype=np.double).reshape((-1, 3))
+        self.bits = bits
+        self.shift = 8 - bits
+
+        side = 1 << bits
+        size = 1 << self.shift
+
+        # Cell bounds in r, g, b order
+        lo = np.arange(side, dtype=np.double) * size
+        r, g, b = np.meshgrid(lo, lo, lo, indexing='ij')
+        lows = np.column_stack((r.ravel(), g.ravel(), b.ravel()))
+        highs = lows + size
+
+        pal = self.palette[None, :, :]
+        keep = []
+        for i in range(0, lows.shape[0], chunk):
+            lo = lows[i:i + chunk, None, :]
+            hi = highs[i:i + chunk, None, :]
+
+            # Distance from each entry to the nearest and farthest point
+            gap = np.maximum(lo - pal, 0.0) + np.maximum(pal - hi, 0.0)
+            near = np.sqrt((gap ** 2).sum(axis=2))
+            reach = np.maximum(np.abs(pal - lo), np.abs(pal - hi))
+            far = np.sqrt((reach ** 2).sum(axis=2))
+
+            # `pad` absorbs rounding, e.g. of fixed-point palettes
+            keep.append(near <= far.min(axis=1)[:, None] + pad)
+        keep = np.concatenate(keep)
+        counts = keep.sum(axis=1)
+
+        self.start = np.zeros(lows.shape[0] + 1, dtype=np.intp)
+        np.cumsum(counts, out=self.start[1:])
+        self.items = np.nonzero(keep)[1].astype(np.intp)
+        for a in (self.start, self.items):
+            a.flags.writeable = False
+
+    @classmethod
+    def from_table(cls, palette, table, bits):
+        """ Grid with the single entry `table[cell]` in each cell, e.g. the
+        centre matches of an InverseColormap for another metric. """
+        grid = cls.__new__(cls)
+        grid.palette = np.array(palette, dtype=np.double).reshape((-1, 3))
+        grid.bits = bits
+        grid.shift = 8 - bits
+        grid.start = np.arange(table.size + 1, dtype=np.intp)
+        grid.items = np.asarray(table, dtype=np.intp)
+        for a in (grid.start, grid.items):
+            a.flags.writeable = False
+        return grid
+
+    @property
+    def nbytes(self):
+        return self.palette.nbytes + self.start.nbytes + self.items.nbytes
+
+    @property
+    def mean_candidates(self):
+        """ Average list length, i.e. entries scanned per search. """
+        return self.items.size / float(self.start.size - 1)
+
+
+def palette_grid(palette, bits=4, metric="rgb"):
+    """ Cached PaletteGrid for a palette.
+
+    For metrics other than "rgb" the grid holds the nearest entry to each
+    cell centre of a `bits` inverse colormap (6 bits if left at the default
+    4), so searches are approximate to within a cell.
+    """
+    if metric == "rgb":
+        return palettes.get(palette, ("grid", bits),
+                            lambda: PaletteGrid(palette, bits))
+    bits = 6 if bits == 4 else bits
+
+    def build():
+        cmap = inverse_colormap(palette, bits, metric)
+        return PaletteGrid.from_table(palette, cmap.table, bits)
+    return palettes.get(palette, ("grid", bits, metric), build)
+
+
+# End of palette grid code
@@ -0,0 +1,102 @@
+import numpy as np
+from PIL import Image, ImageColor
+
+
+# ZX Spectrum screens. A .scr file is the 6912 bytes of screen memory:
+# 6144 bytes of bitmap, one bit per pixel with set bits drawn in ink, and
+# 768 attribute bytes, one per 8x8 cell, holding FLASH (bit 7), BRIGHT
+# (bit 6), PAPER (bits 5-3) and INK (bits 2-0). Bitmap lines are stored in
+# thirds of the screen, and within a third by pixel row of the cell first.
+
+ZX_BASIC = ["#000000", "#0000CD", "#CD0000", "#CD00CD",
+            "#00CD00", "#00CDCD", "#CDCD00", "#CDCDCD"]
+ZX_BASIC = [ImageColor.getrgb(c) for c in ZX_BASIC]
+
+ZX_BRIGHT = ["#000000", "#0000FF", "#FF0000", "#FF00FF",
+             "#00FF00", "#00FFFF", "#FFFF00", "#FFFFFF"]
+ZX_BRIGHT = [ImageColor.getrgb(c) for c in ZX_BRIGHT]
+
+ZX_PALETTES = np.array([ZX_BASIC, ZX_BRIGHT], dtype=np.intp)
+
+WIDTH = 256
+HEIGHT = 192
+CELLS_Y = HEIGHT >> 3
+CELLS_X = WIDTH >> 3
+BITMAP_BYTES = WIDTH * HEIGHT // 8
+SCR_BYTES = BITMAP_BYTES + CELLS_Y * CELLS_X
+
+
+def bitmap_lines():
+    """ Bitmap line, of 32 bytes, holding each pixel row of the screen. """
+    y = np.arange(HEIGHT)
+    return (y & 0xC0) | ((y & 0x07) << 3) | ((y >> 3) & 0x07)
+
+
+BITMAP_LINES = bitmap_lines()
+
+
+def attributes(ink, paper, bright, flash=None):
+    """ Attribute bytes from (24, 32) arrays of ink, paper and flags. """
+    attrs = np.asarray(ink, dtype=np.intp) & 7
+    attrs |= (np.asarray(paper, dtype=np.intp) & 7) << 3
+    attrs |= np.asarray(bright, dtype=bool).astype(np.intp) << 6
+    if flash is not None:
+        attrs |= np.asarray(flash, dtype=bool).astype(np.intp) << 7
+    return attrs.astype(np.uint8)
+
+
+def encode(bits, attrs):
+    """ 6912 bytes of screen memory from a (192, 256) array that is True
+    where pixels are ink and (24, 32) attribute bytes. """
+    bitmap = np.empty((HEIGHT, CELLS_X), dtype=np.uint8)
+    bitmap[BITMAP_LINES] = np.packbits(np.asarray(bits, dtype=bool), axis=1)
+    attrs = np.asarray(attrs, dtype=np.uint8).reshape((CELLS_Y, CELLS_X))
+    return bitmap.tobytes() + attrs.tobytes()
+
+
+def split(data):
+    """ The (192, 256) ink mask and (24, 32) attributes of a screen. """
+    data = np.frombuffer(data, dtype=np.uint8)
+    if data.size != SCR_BYTES:
+        raise ValueError("a screen is %d bytes, not %d" %
+                         (SCR_BYTES, data.size))
+    bitmap = data[:BITMAP_BYTES].reshape((HEIGHT, CELLS_X))
+    bits = np.unpackbits(bitmap[BITMAP_LINES], axis=1).astype(bool)
+    attrs = data[BITMAP_BYTES:].reshape((CELLS_Y, CELLS_X))
+    return bits, attrs
+
+
+def attribute_colours():
+    """ (256, 2, 3) table of the paper and ink colours of each attribute
+    byte. FLASH is ignored. """
+    attrs = np.arange(256)
+    bright = (attrs >> 6) & 1
+    table = np.empty((256, 2, 3), dtype=np.uint8)
+    table[:, 0] = ZX_PALETTES[bright, (attrs >> 3) & 7]
+    table[:, 1] = ZX_PALETTES[bright, attrs & 7]
+    return table
+
+
+ATTRIBUTE_COLOURS = attribute_colours()
+
+
+def decode(data):
+    """ (192, 256, 3) uint8 RGB array of a screen. """
+    bits, attrs = split(data)
+    cell_attrs = np.repeat(np.repeat(attrs, 8, axis=0), 8, axis=1)
+    return ATTRIBUTE_COLOURS[cell_attrs, bits.view(np.uint8)]
+
+
+def scr_image(data):
+    """ RGB image of a screen. """
+    return Image.fromarray(decode(data))
+
+
+def read_scr(fname):
+    with open(fname, "rb") as f:
+        return f.read()
+
+
+def write_scr(data, fname):
+    with open(fname, "wb") as f:
+        f.write(data)
@@ -0,0 +1,31 @@
+import numpy as np
+from PIL import Image
+
+
+# Reproducible inputs and statistics shared by the tests and benchmarks
+
+
+def synthetic_image(w, h, seed=0):
+    """ Smooth colour gradients with noise, so palettes see real structure. """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:h, 0:w].astype(np.double)
+    r = 127.5 + 127.5 * np.sin(x / (w / 3.0) + rng.uniform(0, 6))
+    g = 127.5 + 127.5 * np.sin(y / (h / 2.0) + rng.uniform(0, 6))
+    b = 255.0 * (x + y) / (w + h)
+    im_array = np.dstack((r, g, b)) + rng.normal(0, 12, (h, w, 3))
+    return Image.fromarray(np.clip(im_array, 0, 255).astype(np.uint8))
+
+
+def synthetic_palette(num_colours, seed=0):
+    rng = np.random.RandomState(seed + num_colours)
+    return [tuple(int(v) for v in c)
+            for c in rng.randint(0, 256, (num_colours, 3))]
+
+
+def block_means(im_array, size=16):
+    """ Mean of each `size` x `size` block, to compare dithered images. """
+    h = im_array.shape[0] // size * size
+    w = im_array.shape[1] // size * size
+    blocks = im_array[:h, :w].astype(np.double)
+    blocks = blocks.reshape(h // size, size, w // size, size, -1)
+    return blocks.mean(axis=(1, 3))
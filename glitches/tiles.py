@@ -0,0 +1,144 @@
+import os
+
+import numpy as np
+
+from glitches import colour, dithering
+
+
+# Memory-mapped images. An image is a uint8 array of shape (h, w, 3) for
+# RGB or (h, w) for L, kept in a .npy file or a raw file of bare pixels.
+# Stages read and write such files a band of rows at a time, so neither
+# the input nor the output has to fit in memory, and processes can hand
+# images to each other through the page cache instead of encoding them.
+
+
+def is_npy(path):
+    return os.path.splitext(path)[1].lower() == ".npy"
+
+
+def open_image(path, shape=None, mode="r"):
+    """ Memory-map an existing image file.
+
+    A raw file needs its `shape`, (h, w, 3) or (h, w); a .npy file carries
+    its own.
+    """
+    if is_npy(path):
+        return np.load(path, mmap_mode=mode)
+    if shape is None:
+        raise ValueError("raw image %s needs a shape" % path)
+    return np.memmap(path, dtype=np.uint8, mode=mode, shape=tuple(shape))
+
+
+def create_image(path, shape):
+    """ Create an image file of `shape` and memory-map it for writing. """
+    if is_npy(path):
+        return np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8,
+                                         shape=tuple(shape))
+    return np.memmap(path, dtype=np.uint8, mode="w+", shape=tuple(shape))
+
+
+def as_image(source, shape=None):
+    """ An array for `source`, which is an array or an image file path. """
+    if isinstance(source, np.ndarray):
+        return source
+    return open_image(source, shape)
+
+
+def as_output(target, shape):
+    """ An array to write to for `target`: an array, an image file path to
+    create, or None for a new in-memory array. """
+    if target is None:
+        return np.empty(shape, dtype=np.uint8)
+    if isinstance(target, np.ndarray):
+        if target.shape != tuple(shape):
+            raise ValueError("output shape %s does not match %s" %
+                             (target.shape, tuple(shape)))
+        return target
+    return create_image(target, shape)
+
+
+def tile_rows(height, rows=256, align=1):
+    """ (y0, y1) row bands of about `rows` rows, starting on multiples of
+    `align`. """
+    rows = max(align, (rows + align - 1) // align * align)
+    return [(y, min(height, y + rows)) for y in range(0, height, rows)]
+
+
+def map_tiles(func, source, target=None, shape=None, out_shape=None,
+              rows=256, align=1):
+    """ Apply `func(src, out)` to matching bands of rows of two images.
+
+    `source` and `target` are arrays or image file paths (see `as_image`
+    and `as_output`); `out_shape` defaults to the shape of the source. Each
+    band is read and written in place, and memory-mapped output is flushed
+    at the end. Returns the output array.
+    """
+    src = as_image(source, shape)
+    out = as_output(target, src.shape if out_shape is None else out_shape)
+    for y0, y1 in tile_rows(src.shape[0], rows, align):
+        func(src[y0:y1], out[y0:y1])
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+# Tiled stages
+
+
+def stage_shape(src, indexed=False):
+    """ Output shape of a stage: that of the source, or (h, w) for an
+    image of indices. """
+    return src.shape[:2] if indexed else src.shape
+
+
+def quantize_tiles(source, pal, target=None, shape=None, metric="rgb",
+                   rows=256, indexed=False):
+    """ `colour.quantize` over an RGB image file or array, a band at a
+    time. With `indexed`, the output is an (h, w) image of palette indices,
+    which needs a palette of at most 256 colours. """
+    src = as_image(source, shape)
+    if indexed:
+        colour.indexed_colours(pal)
+
+    def func(src, out):
+        colour.quantize_array(src, pal, metric, out, indexed)
+    return map_tiles(func, src, target, out_shape=stage_shape(src, indexed),
+                     rows=rows)
+
+
+def bayer_tiles(source, palette=None, target=None, shape=None, matrix=4,
+                spread=None, rows=256, indexed=False):
+    """ Ordered dithering of an image file or array, a band at a time.
+
+    L images are dithered as by `dithering.bayer_mono`, RGB images to an
+    RGB `palette` as by `dithering.bayer_rgb`. Bands start on multiples of
+    the matrix size so they join without seams. With `indexed`, the output
+    is an (h, w) image of palette indices.
+    """
+    if dithering.bayer_matrix(matrix) is None:
+        raise ValueError("no %dx%d Bayer matrix" % (matrix, matrix))
+    src = as_image(source, shape)
+    if indexed:
+        colour.indexed_colours(palette if src.ndim == 3 else
+                               dithering.mono_colours(palette))
+
+    def func(src, out):
+        if src.ndim == 2:
+            dithering.bayer_mono_array(src, palette, matrix, out, indexed)
+        else:
+            dithering.bayer_rgb_array(src, palette, matrix, spread, out,
+                                      indexed=indexed)
+    return map_tiles(func, src, target, out_shape=stage_shape(src, indexed),
+                     rows=rows, align=matrix)
+
+
+def replace_colours_tiles(source, pal_a, pal_b, target=None, shape=None,
+                          indexed=False, rows=256):
+    """ `colour.replace_colours` over an image file or array, a band at a
+    time. The output is always RGB. """
+    src = as_image(source, shape)
+
+    def func(src, out):
+        colour.replace_colours_array(src, pal_a, pal_b, indexed, out)
+    return map_tiles(func, src, target, out_shape=src.shape[:2] + (3,),
+                     rows=rows)
@@ -1,34 +1,100 @@
-from PIL import Image
+from PIL import Image, ImageOps
 
 
-def resize(image, w, h, bgcolor="black"):
-    ow, oh = image.size
+def fit(size, w, h):
+    """ Scaled size and letterbox offset of an image of `size` for resize.
+
+    Returns ((nw, nh), (x, y), canvas) where canvas is the (w, h) size of
+    the letterbox, or None when the image is only scaled.
+    """
+    ow, oh = size
     if w == -1 and h == -1:
-        return image
+        return (ow, oh), (0, 0), None
     elif w == -1 and h != -1:
         w = ow * (float(h) / float(oh))
-        w = int(w)
-        return image.resize((w, h))
+        return (int(w), h), (0, 0), None
     elif w != -1 and h == -1:
         h = oh * (float(w) / float(ow))
-        h = int(h)
-        return image.resize((w, h))
+        return (w, int(h)), (0, 0), None
     else:
         # Fit longest axis
         if ow <= oh:
             nh = h
-            nw = (float(nh) / float(oh)) * ow
-            nw = int(nw)
-            im2 = image.resize((nw, nh))
-            wdiff = int((w - nw) / 2.0)
-            im = Image.new("RGB", (w, h), bgcolor)
-            im.paste(im2, (wdiff, 0))
+            nw = int((float(nh) / float(oh)) * ow)
+            return (nw, nh), (int((w - nw) / 2.0), 0), (w, h)
         else:
             nw = w
-            nh = (float(nw) / float(ow)) * oh
-            nh = int(nh)
-            im2 = image.resize((nw, nh))
-            hdiff = int((h - nh) / 2.0)
-            im = Image.new("RGB", (w, h), bgcolor)
-            im.paste(im2, (0, hdiff))
-        return im
+            nh = int((float(nw) / float(ow)) * oh)
+            return (nw, nh), (0, int((h - nh) / 2.0)), (w, h)
+
+
+def target_size(size, w, h):
+    """ Size `resize` gives an image of `size`. """
+    scaled, _, canvas = fit(size, w, h)
+    return canvas or scaled
+
+
+def resize(image, w, h, bgcolor="black"):
+    if w == -1 and h == -1:
+        return image
+    scaled, offset, canvas = fit(image.size, w, h)
+    im2 = image.resize(scaled)
+    if canvas is None:
+        return im2
+    im = Image.new("RGB", canvas, bgcolor)
+    im.paste(im2, offset)
+    return im
+
+
+def load(path, w=-1, h=-1, bgcolor="black", out=None, gap=2,
+         equalize=False):
+    """ Open an image already resized as by `resize(image, w, h)`.
+
+    Large images are never decoded at full size where it can be avoided:
+    JPEGs are decoded at a reduced scale (draft mode) no smaller than the
+    target, other formats are shrunk by an integer factor with `reduce`
+    while at least `gap` times the target, and the remaining resize goes
+    straight into the letterbox canvas. `out` may be a preallocated RGB
+    canvas of the target size to fill instead of a new one. With
+    `equalize`, the histogram of the image is equalized before it is
+    letterboxed. Returns an RGB image.
+    """
+    image = Image.open(path)
+    if w == -1 and h == -1:
+        image = image.convert("RGB")
+        if equalize:
+            image = ImageOps.equalize(image)
+        if out is not None:
+            out.paste(image)
+            return out
+        return image
+
+    scaled, offset, canvas = fit(image.size, w, h)
+
+    # Decode at 1/2, 1/4 or 1/8 scale where the format supports it
+    image.draft("RGB", scaled)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    # Shrink by an integer factor, leaving a final resize of at least `gap`
+    factor = min(image.size[0] // max(scaled[0], 1),
+                 image.size[1] // max(scaled[1], 1)) // gap
+    if factor > 1 and hasattr(image, "reduce"):
+        image = image.reduce(factor)
+
+    if image.size != scaled:
+        image = image.resize(scaled)
+    if equalize:
+        image = ImageOps.equalize(image)
+    if canvas is None:
+        if out is not None:
+            out.paste(image)
+            return out
+        return image
+
+    if out is None:
+        out = Image.new("RGB", canvas, bgcolor)
+    else:
+        out.paste(bgcolor, (0, 0) + canvas)
+    out.paste(image, offset)
+    return out
@@ -0,0 +1,172 @@
+from scipy.weave import inline
+from scipy.weave import converters
+
+
+# Floyd-Steinberg kernels. Both dither columns x0..x1-1 of rows y0..y1-1 of
+# im_array in place, diffusing error into the following row when im_array
+# has one, and write each pixel's palette index to `indices` unless it is
+# empty. The GIL is released while they run.
+
+FS_MONO_CODE = """
+int col_idx;
+double nearest, tmp, dist;
+double quant_error, old_value, new_value;
+Py_BEGIN_ALLOW_THREADS
+for (int y = y0; y < y1; y++)
+{
+    for (int x = x0; x < x1; x++)
+    {
+        // Clamp Colour
+        old_value = im_array(y, x);
+        old_value = old_value < 0 ? 0 : old_value;
+        old_value = old_value > 255 ? 255 : old_value;
+        im_array(y, x) = old_value;
+
+        if (nc == 0)
+        {
+            col_idx = im_array(y, x) <= 128? 0 : 1;
+            new_value = col_idx ? 255 : 0;
+        }
+        else
+        {
+            col_idx = -1;
+            nearest = -1;
+
+
+            // Find Nearest Colour
+            for (int c=0; c<nc; c++)
+            {
+                dist = 0;
+                tmp = im_array(y, x) - pal_array(c);
+                dist += tmp * tmp;
+                if (col_idx == -1 || dist < nearest)
+                {
+                    col_idx = c;
+                    nearest = dist;
+                }
+            }
+            new_value = pal_array(col_idx);
+        }
+
+        if (ni > 0)
+        {
+            indices(y, x) = col_idx;
+        }
+
+        // Set colour
+        old_value = im_array(y, x);
+        quant_error = old_value - new_value;
+        im_array(y, x) = new_value;
+
+        // Error diffusion
+        if (x < nx - 1)
+        {
+            im_array(y, x+1) += quant_error * (7.0/16.0);
+        }
+        if (y < ny - 1)
+        {
+            if (x > 0)
+            {
+                im_array(y+1, x-1) += quant_error * (3.0/16.0);
+            }
+            im_array(y+1, x) += quant_error * (5.0/16.0);
+            if (x < nx - 1)
+            {
+                im_array(y+1, x+1) += quant_error * (1.0/16.0);
+            }
+        }
+    }
+}
+Py_END_ALLOW_THREADS
+"""
+
+FS_RGB_CODE = """
+int col_idx;
+double nearest, tmp, dist;
+double quant_error, old_value, new_value;
+Py_BEGIN_ALLOW_THREADS
+for (int y = y0; y < y1; y++)
+{
+    for (int x = x0; x < x1; x++)
+    {
+        col_idx = -1;
+        nearest = -1;
+
+        // Clamp Colour
+        for (int band=0; band < 3; band++)
+        {
+            old_value = im_array(y, x, band);
+            old_value = old_value < 0 ? 0 : old_value;
+            old_value = old_value > 255 ? 255 : old_value;
+            im_array(y, x, band) = old_value;
+        }
+
+        // Find Nearest Colour
+        for (int c=0; c<nc; c++)
+        {
+            dist = 0;
+            for (int band=0; band < 3; band++)
+            {
+                tmp = im_array(y, x, band) - pal_array(c, band);
+                dist += tmp * tmp;
+            }
+            if (col_idx == -1 || dist < nearest)
+            {
+                col_idx = c;
+                nearest = dist;
+            }
+        }
+
+        if (ni > 0)
+        {
+            indices(y, x) = col_idx;
+        }
+
+        // Set colour
+        for (int band = 0; band < 3; band++)
+        {
+            old_value = im_array(y, x, band);
+            new_value = pal_array(col_idx, band);
+            quant_error = old_value - new_value;
+            im_array(y, x, band) = new_value;
+
+            // Error diffusion
+            if (x < nx - 1)
+            {
+                im_array(y, x+1, band) += quant_error * (7.0/16.0);
+            }
+            if (y < ny - 1)
+            {
+                if (x > 0)
+                {
+                    im_array(y+1, x-1, band) += quant_error * (3.0/16.0);
+                }
+                im_array(y+1, x, band) += quant_error * (5.0/16.0);
+                if (x < nx - 1)
+                {
+                    im_array(y+1, x+1, band) += quant_error * (1.0/16.0);
+                }
+            }
+        }
+    }
+}
+Py_END_ALLOW_THREADS
+"""
+
+
+def fs_mono(im_array, pal_array, y0, y1, x0, x1, indices):
+    ny, nx = im_array.shape[:2]  # noqa
+    nc = pal_array.shape[0]  # noqa
+    ni = indices.shape[0]  # noqa
+    inline(FS_MONO_CODE, ['im_array', 'pal_array', 'indices', 'nx', 'ny',
+                          'nc', 'ni', 'y0', 'y1', 'x0', 'x1'],
+           type_converters=converters.blitz)
+
+
+def fs_rgb(im_array, pal_array, y0, y1, x0, x1, indices):
+    ny, nx = im_array.shape[:2]  # noqa
+    nc = pal_array.shape[0]  # noqa
+    ni = indices.shape[0]  # noqa
+    inline(FS_RGB_CODE, ['im_array', 'pal_array', 'indices', 'nx', 'ny',
+                         'nc', 'ni', 'y0', 'y1', 'x0', 'x1'],
+           type_converters=converters.blitz)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+""" Benchmarks for the glitches pipeline stages.
+
+Runs each stage on synthetic images of several sizes and palettes, reports
+throughput in megapixels per second and peak allocated memory, and saves
+the results as JSON so a later run can be compared against them:
+
+    python scripts/benchmark.py -o baseline.json
+    python scripts/benchmark.py -b baseline.json
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from glitches import colour as gl_c  # noqa: E402
+from glitches import colourize as gl_cz  # noqa: E402
+from glitches import dithering as gl_d  # noqa: E402
+from glitches import backends as gl_b  # noqa: E402
+from glitches.synthetic import (block_means, synthetic_image,  # noqa: E402
+                                synthetic_palette)
+
+
+# Measurement
+
+
+def measure(func, repeat):
+    """ Best wall time over `repeat` runs and peak bytes allocated. """
+    func()  # warm caches and kernels
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def cases(sizes, palettes):
+    """ Yield (stage, size, colours, pixels, func) for every benchmark. """
+    for w, h in sizes:
+        image = synthetic_image(w, h)
+        grey = image.convert("L")
+        pixels = w * h
+        for n in palettes:
+            pal = synthetic_palette(n)
+            monos = gl_c.mono_palette(n)
+            quantized = gl_c.quantize(image, pal)
+            indexed = gl_c.quantize(image, pal, indexed=True)
+
+            yield ("median_cut", (w, h), n, pixels,
+                   lambda: gl_c.median_cut(image, n))
+            yield ("octree_palette", (w, h), n, pixels,
+                   lambda: gl_c.octree_palette(image, n))
+            yield ("quantize", (w, h), n, pixels,
+                   lambda: gl_c.quantize(image, pal))
+            yield ("quantize/lab", (w, h), n, pixels,
+                   lambda: gl_c.quantize(image, pal, metric="lab"))
+            yield ("quantize/indexed", (w, h), n, pixels,
+                   lambda: gl_c.quantize(image, pal, indexed=True))
+            yield ("replace_colours", (w, h), n, pixels,
+                   lambda: gl_c.replace_colours(quantized, pal, monos))
+            yield ("replace_colours/indexed", (w, h), n, pixels,
+                   lambda: gl_c.replace_colours(indexed, pal, monos))
+            yield ("floyd_steinberg_rgb", (w, h), n, pixels,
+                   lambda: gl_d.floyd_steinberg_rgb(image, pal))
+            yield ("floyd_steinberg_mono", (w, h), n, pixels,
+                   lambda: gl_d.floyd_steinberg_mono(grey, monos))
+            yield ("floyd_steinberg_rgb/lab", (w, h), n, pixels,
+                   lambda: gl_d.floyd_steinberg_rgb(image, pal, metric="lab"))
+            for p in ("float32", "int16"):
+                yield ("floyd_steinberg_rgb/%s" % p, (w, h), n, pixels,
+                       lambda: gl_d.floyd_steinberg_rgb(image, pal,
+                                                        precision=p))
+            for m in (2, 4, 8):
+                yield ("bayer_mono/%d" % m, (w, h), n, pixels,
+                       lambda: gl_d.bayer_mono(grey, monos, m))
+            yield ("colourize", (w, h), n, pixels,
+                   lambda: gl_cz.colourize(image, pal))
+
+    # The ZX Spectrum attribute pass works on whole 256x192 screens
+    import zx
+    screen = synthetic_image(256, 192)
+    yield ("zx_screen", (256, 192), 16, 256 * 192,
+           lambda: zx.zx_screen(screen))
+    yield ("zx_scr", (256, 192), 16, 256 * 192,
+           lambda: zx.zx_scr(screen))
+    import glitches.scr as gl_s
+    scr = zx.zx_scr(screen)
+    yield ("scr_decode", (256, 192), 16, 256 * 192,
+           lambda: gl_s.decode(scr))
+
+
+def run(sizes, palettes, repeat, only=None):
+    results = []
+    for stage, size, n, pixels, func in cases(sizes, palettes):
+        if only and not any(stage.startswith(o) for o in only):
+            continue
+        elapsed, peak = measure(func, repeat)
+        result = {"stage": stage, "width": size[0], "height": size[1],
+                  "colours": n, "seconds": elapsed,
+                  "mpx_per_s": pixels / 1e6 / max(elapsed, 1e-9),
+                  "peak_bytes": peak}
+        results.append(result)
+        print("%-28s %5dx%-5d %4d colours %9.2f MP/s %10d bytes" %
+              (stage, size[0], size[1], n, result["mpx_per_s"], peak))
+    return results
+
+
+def result_key(r):
+    return (r["stage"], r["width"], r["height"], r["colours"])
+
+
+def compare(results, baseline, tolerance):
+    """ Print throughput against a baseline run; return the regressions. """
+    base = dict((result_key(r), r) for r in baseline["results"])
+    regressions = []
+    for r in results:
+        b = base.get(result_key(r))
+        if b is None:
+            continue
+        ratio = r["mpx_per_s"] / max(b["mpx_per_s"], 1e-9)
+        flag = ""
+        if ratio < 1.0 - tolerance:
+            flag = "  REGRESSION"
+            regressions.append(r)
+        print("%-28s %5dx%-5d %4d colours %6.2fx%s" %
+              (r["stage"], r["width"], r["height"], r["colours"], ratio,
+               flag))
+    return regressions
+
+
+def check_precision(sizes, palettes):
+    """ Check Floyd-Steinberg precisions against the double result and
+    gl_d.FS_TOLERANCES; return the failures. """
+    failures = []
+    for w, h in sizes:
+        for n in palettes:
+            image = synthetic_image(w, h, seed=n)
+            pal = synthetic_palette(n)
+            monos = gl_c.mono_palette(n)
+            for mode in ("RGB", "MONO"):
+                src = image if mode == "RGB" else image.convert("L")
+                src_pal = pal if mode == "RGB" else monos
+                ref = np.asarray(gl_d.floyd_steinberg(src, src_pal, mode))
+                for p, (block_tol, mean_tol) in \
+                        sorted(gl_d.FS_TOLERANCES.items()):
+                    out = np.asarray(gl_d.floyd_steinberg(src, src_pal, mode,
+                                                          precision=p))
+                    block = np.abs(block_means(out) - block_means(ref)).max()
+                    mean = abs(out.mean() - ref.mean())
+                    flag = ""
+                    if block > block_tol or mean > mean_tol:
+                        flag = "  FAIL"
+                        failures.append((p, mode, (w, h), n))
+                    print("%-8s %-4s %5dx%-5d %4d colours block %6.2f "
+                          "mean %6.3f%s" % (p, mode, w, h, n, block, mean,
+                                            flag))
+    return failures
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-s", "--sizes", type=str,
+                        default="64x64,256x256,1024x768",
+                        help="comma separated WxH image sizes")
+    parser.add_argument("-p", "--palettes", type=str, default="2,4,16,64,256",
+                        help="comma separated palette sizes")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-k", "--only", type=str, default=None,
+                        help="comma separated stage name prefixes to run")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="save results as JSON")
+    parser.add_argument("-b", "--baseline", type=str, default=None,
+                        help="compare against saved JSON results")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.1,
+                        help="allowed throughput drop against the baseline")
+    parser.add_argument("--check-precision", action="store_true",
+                        default=False,
+                        help="check Floyd-Steinberg precisions against "
+                             "double instead of timing")
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in s.split("x"))
+             for s in args.sizes.split(",")]
+    palettes = [int(n) for n in args.palettes.split(",")]
+    only = args.only.split(",") if args.only else None
+
+    if args.check_precision:
+        if check_precision(sizes, palettes):
+            sys.exit(1)
+        return
+
+    results = run(sizes, palettes, args.repeat, only)
+    report = {"python": platform.python_version(),
+              "numpy": np.__version__,
+              "backend": gl_b.get_backend().name,
+              "machine": platform.machine(),
+              "results": results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from glitches.cache import PaletteCache
+
+
+# Palette-keyed LRU cache
+
+
+def palette(i):
+    return [(i, 0, 0), (0, i, 0)]
+
+
+def block(nbytes):
+    return lambda: np.zeros(nbytes, dtype=np.uint8)
+
+
+def test_hits_and_misses():
+    cache = PaletteCache()
+    built = []
+
+    def build():
+        built.append(1)
+        return np.zeros(10)
+    first = cache.get(palette(1), "kind", build)
+    assert cache.get(palette(1), "kind", build) is first
+    # Equal colours hit, whatever sequence type holds them
+    assert cache.get(np.array(palette(1)), "kind", build) is first
+    cache.get(palette(1), "other", build)
+    cache.get(palette(2), "kind", build)
+    assert len(built) == 3
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 3)
+    assert stats["entries"] == 3
+    assert stats["nbytes"] == 3 * 80
+
+
+def test_least_recently_used_go_first():
+    cache = PaletteCache(max_bytes=300)
+    a = cache.get(palette(1), "k", block(100))
+    cache.get(palette(2), "k", block(100))
+    cache.get(palette(3), "k", block(100))
+    # Touch 1, so 2 is now the oldest
+    assert cache.get(palette(1), "k", block(100)) is a
+    cache.get(palette(4), "k", block(100))
+    assert len(cache) == 3
+    assert cache.nbytes == 300
+
+    misses = cache.misses
+    cache.get(palette(1), "k", block(100))
+    cache.get(palette(3), "k", block(100))
+    cache.get(palette(4), "k", block(100))
+    assert cache.misses == misses
+    cache.get(palette(2), "k", block(100))
+    assert cache.misses == misses + 1
+
+
+def test_limits():
+    cache = PaletteCache(max_bytes=100)
+    cache.get(palette(1), "k", block(60))
+    # The newest entry stays, however large
+    big = cache.get(palette(2), "k", block(500))
+    assert len(cache) == 1 and cache.nbytes == 500
+    assert cache.get(palette(2), "k", block(500)) is big
+
+    cache.set_limit(1000)
+    cache.get(palette(3), "k", block(400))
+    assert len(cache) == 2
+    cache.set_limit(450)
+    assert len(cache) == 1 and cache.nbytes == 400
+
+    cache.clear()
+    assert cache.stats() == {"entries": 0, "nbytes": 0, "max_bytes": 450,
+                             "hits": 0, "misses": 0}
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+
+import glitches.dithering as gl_d
+from glitches import tiles
+from glitches.colour import LOVE, mono_palette, quantize, replace_colours
+from glitches.colourize import colourize
+from glitches.lut import inverse_colormap, nearest, palette_grid
+from glitches.synthetic import synthetic_image, synthetic_palette
+
+
+# Fast paths that promise the same output as a simpler reference
+
+
+@pytest.fixture
+def image():
+    return synthetic_image(96, 64)
+
+
+def same(a, b):
+    return (np.asarray(a) == np.asarray(b)).all()
+
+
+def random_pixels(n, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, (n, 3)) \
+        .astype(np.uint8)
+
+
+# Inverse colormap and palette grid against a brute-force search
+
+
+@pytest.mark.parametrize("num_colours", [2, 16, 64])
+def test_colormap_matches_brute_force(num_colours):
+    pal = np.array(synthetic_palette(num_colours), dtype=np.uint8)
+    pixels = np.concatenate((random_pixels(50000), pal, 255 - pal))
+    found = inverse_colormap(pal).map(pixels)
+    assert (found == nearest(pixels, pal)).all()
+
+
+def test_lab_colormap_matches_brute_force():
+    pal = np.array(synthetic_palette(32), dtype=np.uint8)
+    pixels = random_pixels(20000, seed=1)
+    found = inverse_colormap(pal, metric="lab").map(pixels)
+    assert (found == nearest(pixels, pal, metric="lab")).all()
+
+
+@pytest.mark.parametrize("num_colours", [16, 64])
+def test_grid_lists_hold_nearest(num_colours):
+    pal = np.array(synthetic_palette(num_colours), dtype=np.double)
+    grid = palette_grid(pal)
+    points = np.random.RandomState(2).uniform(0, 255.999, (5000, 3))
+    cells = points.astype(np.intp) >> grid.shift
+    cells = (cells[:, 0] << (2 * grid.bits)) | \
+        (cells[:, 1] << grid.bits) | cells[:, 2]
+    best = nearest(points, pal)
+    for cell, b in zip(cells, best):
+        assert b in grid.items[grid.start[cell]:grid.start[cell + 1]]
+
+
+@pytest.mark.parametrize("num_colours", [16, 64])
+@pytest.mark.parametrize("precision", ["double", "int16"])
+def test_grid_matches_full_scan(monkeypatch, image, num_colours, precision):
+    pal = synthetic_palette(num_colours)
+    grid = gl_d.floyd_steinberg_rgb(image, pal, precision=precision)
+    monkeypatch.setattr(gl_d, "GRID_MIN_COLOURS", 1 << 30)
+    full = gl_d.floyd_steinberg_rgb(image, pal, precision=precision)
+    assert same(grid, full)
+
+
+# Streamed, threaded and tiled dithering against the whole-image path
+
+
+@pytest.mark.parametrize("mode", ["RGB", "MONO"])
+@pytest.mark.parametrize("precision", ["double", "int16"])
+def test_stream_matches_whole(image, mode, precision):
+    src = image if mode == "RGB" else image.convert("L")
+    pal = synthetic_palette(16) if mode == "RGB" else mono_palette(4)
+    whole = gl_d.floyd_steinberg(src, pal, mode, precision=precision)
+    stream = gl_d.floyd_steinberg_stream(src, pal, mode, strip=7,
+                                         precision=precision)
+    assert same(stream, whole)
+    out = np.empty_like(np.asarray(whole))
+    gl_d.floyd_steinberg_stream(np.asarray(src), pal, mode, out=out,
+                                precision=precision)
+    assert same(out, whole)
+
+
+@pytest.mark.parametrize("mode", ["RGB", "MONO"])
+def test_wavefront_matches_serial(image, mode):
+    src = image if mode == "RGB" else image.convert("L")
+    pal = synthetic_palette(16) if mode == "RGB" else mono_palette(4)
+    serial = gl_d.floyd_steinberg(src, pal, mode)
+    assert same(gl_d.floyd_steinberg(src, pal, mode, workers=3), serial)
+
+
+def test_bayer_pool_matches_serial(image):
+    pal = synthetic_palette(16)
+    assert same(gl_d.bayer_rgb(image, pal, 4, workers=2),
+                gl_d.bayer_rgb(image, pal, 4))
+    grey = image.convert("L")
+    assert same(gl_d.bayer_mono(grey, mono_palette(4), 8, workers=2),
+                gl_d.bayer_mono(grey, mono_palette(4), 8))
+
+
+def test_tiles_match_whole(image, tmp_path):
+    pal = synthetic_palette(16)
+    im_array = np.asarray(image)
+    quantized = quantize(image, pal)
+    assert same(tiles.quantize_tiles(im_array, pal, rows=13), quantized)
+    assert same(tiles.bayer_tiles(im_array, pal, rows=13),
+                gl_d.bayer_rgb(image, pal))
+    grey = image.convert("L")
+    assert same(tiles.bayer_tiles(np.asarray(grey), mono_palette(4),
+                                  matrix=8, rows=13),
+                gl_d.bayer_mono(grey, mono_palette(4), 8))
+    recoloured = tiles.replace_colours_tiles(np.asarray(quantized), pal,
+                                             LOVE * 4, rows=13)
+    assert same(recoloured, replace_colours(quantized, pal, LOVE * 4))
+
+    # Through memory-mapped files, .npy and raw
+    src = str(tmp_path / "in.npy")
+    np.save(src, im_array)
+    out = tiles.quantize_tiles(src, pal, str(tmp_path / "out.raw"), rows=13)
+    assert same(out, quantized)
+    raw = tiles.open_image(str(tmp_path / "out.raw"), im_array.shape)
+    assert same(raw, quantized)
+
+
+# Fused colourize against quantize -> dither -> replace_colours
+
+
+def three_stages(image, out_palette, dither, matrix):
+    n = len(out_palette)
+    monos = mono_palette(n)
+    grey = quantize(image, mono_palette(4 * n))
+    if dither == "FS":
+        dithered = gl_d.floyd_steinberg(grey, monos, mode="MONO")
+    else:
+        dithered = gl_d.bayer_mono(grey, monos, matrix)
+    return replace_colours(dithered.convert("RGB"), monos, out_palette)
+
+
+@pytest.mark.parametrize("dither,matrix", [("BAYER", 2), ("BAYER", 4),
+                                           ("BAYER", 8), ("FS", 4)])
+def test_colourize_matches_three_stages(image, dither, matrix):
+    fused = colourize(image, LOVE, dither=dither, matrix=matrix)
+    assert same(fused, three_stages(image, LOVE, dither, matrix))
+
+
+# Indexed outputs against their RGB and L counterparts
+
+
+def test_indexed_outputs_match(image):
+    pal = synthetic_palette(16)
+    grey = image.convert("L")
+    monos = mono_palette(4)
+    pairs = [
+        (quantize(image, pal, indexed=True), quantize(image, pal)),
+        (gl_d.floyd_steinberg_rgb(image, pal, precision="int16",
+                                  indexed=True),
+         gl_d.floyd_steinberg_rgb(image, pal, precision="int16")),
+        (gl_d.floyd_steinberg_mono(grey, monos, indexed=True),
+         gl_d.floyd_steinberg_mono(grey, monos)),
+        (gl_d.bayer_rgb(image, pal, indexed=True), gl_d.bayer_rgb(image, pal)),
+        (gl_d.bayer_mono(grey, None, indexed=True), gl_d.bayer_mono(grey)),
+        (colourize(image, LOVE, indexed=True), colourize(image, LOVE)),
+    ]
+    for indexed, plain in pairs:
+        assert indexed.mode == "P"
+        assert same(indexed.convert(plain.mode), plain)
+
+
+def test_indexed_keeps_duplicate_entries(image):
+    pal = [(0, 0, 0), (255, 255, 255), (0, 0, 0)]
+    indices = np.asarray(gl_d.floyd_steinberg_rgb(image, pal, indexed=True))
+    assert set(np.unique(indices)) <= {0, 1}
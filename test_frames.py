@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import os
+
+import pytest
+from PIL import Image
+
+from glitches import frames
+
+
+# Frame sources and sinks
+
+
+def clip(n=3):
+    return [Image.new("RGB", (8, 6), c)
+            for c in ("red", "blue", "green", "white")[:n]]
+
+
+def test_existing_files_are_not_patterns(tmp_path):
+    for name in ("photo[1].png", "50%.png"):
+        path = str(tmp_path / name)
+        assert frames.is_sequence(path)
+        clip(1)[0].save(path)
+        assert not frames.is_sequence(path)
+        assert len(list(frames.read_frames(path))) == 1
+
+
+def test_write_gif_without_frames(tmp_path):
+    target = str(tmp_path / "out.gif")
+    with pytest.raises(ValueError):
+        frames.write_gif(iter([]), target)
+    assert not os.path.exists(target)
+
+
+def test_write_frames_by_target(tmp_path):
+    gif = str(tmp_path / "out.gif")
+    assert frames.write_frames(iter(clip()), gif) == 3
+    assert Image.open(gif).format == "GIF"
+    assert Image.open(gif).n_frames == 3
+
+    png = str(tmp_path / "out.png")
+    assert frames.write_frames(iter(clip()), png) == 1
+    assert Image.open(png).format == "PNG"
+
+    pattern = str(tmp_path / "seq" / "%03d.png")
+    assert frames.write_frames(iter(clip()), pattern) == 3
+    assert frames.sequence_paths(pattern) == [pattern % i for i in range(3)]
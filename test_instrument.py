@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from glitches import instrument as gl_i
+
+
+# Stage timing and peak memory
+
+MB = 1 << 20
+
+
+@pytest.fixture
+def tracing():
+    started = not tracemalloc.is_tracing()
+    gl_i.start_tracing()
+    yield
+    if started:
+        tracemalloc.stop()
+
+
+def allocate(nbytes):
+    block = np.ones(nbytes, dtype=np.uint8)
+    del block
+
+
+def events():
+    with gl_i.Recorder() as recorder:
+        with gl_i.stage("outer", 100):
+            allocate(8 * MB)
+            with gl_i.stage("inner"):
+                allocate(1 * MB)
+            with gl_i.stage("big"):
+                allocate(16 * MB)
+    return dict((e["stage"], e) for e in recorder.events)
+
+
+def test_stage_event():
+    event = events()["outer"]
+    assert event["pixels"] == 100
+    assert event["wall"] >= 0 and event["cpu"] >= 0
+    assert event["peak_bytes"] is None
+
+
+def test_nested_peaks(tracing):
+    found = events()
+    assert MB <= found["inner"]["peak_bytes"] < 2 * MB
+    assert 16 * MB <= found["big"]["peak_bytes"] < 17 * MB
+    # The outer stage keeps its own peak and those of the stages inside it
+    assert found["outer"]["peak_bytes"] >= 16 * MB
+    with gl_i.Recorder() as recorder:
+        with gl_i.stage("outer"):
+            allocate(8 * MB)
+            with gl_i.stage("inner"):
+                pass
+    assert recorder.events[-1]["peak_bytes"] >= 8 * MB
+
+
+def test_errors_are_recorded():
+    with gl_i.Recorder() as recorder:
+        with pytest.raises(KeyError):
+            with gl_i.stage("failing"):
+                raise KeyError("x")
+    assert recorder.events[0]["error"] == "KeyError"
+    assert not gl_i.open_stages
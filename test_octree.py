@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+
+from glitches.colour import Octree, octree_palette
+from glitches.synthetic import synthetic_image
+
+
+# Bounded-memory octree palettes
+
+
+def noise(n, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, (n, 3)) \
+        .astype(np.uint8)
+
+
+@pytest.mark.parametrize("max_leaves", [8, 64, 500])
+def test_leaves_stay_bounded(max_leaves):
+    tree = Octree(max_leaves)
+    total = 0
+    for seed in range(6):
+        pixels = noise(20000, seed)
+        tree.add(pixels)
+        total += len(pixels)
+        assert len(tree) <= max_leaves
+        # Merging moves pixels between leaves, it never drops them
+        assert tree.count.sum() == total
+        # Depth, code, count and three channel sums of 8 bytes per leaf
+        assert tree.nbytes <= max_leaves * 48
+
+
+def test_exact_below_the_bound():
+    pixels = np.array([(0, 0, 0)] * 3 + [(255, 0, 0)] * 2 + [(9, 9, 9)],
+                      dtype=np.uint8)
+    tree = Octree(16)
+    tree.add(pixels)
+    colours, counts = tree.colours()
+    found = sorted(zip(map(tuple, colours), counts))
+    assert found == [((0, 0, 0), 3), ((9, 9, 9), 1), ((255, 0, 0), 2)]
+
+
+@pytest.mark.parametrize("num_colours", [2, 16, 64])
+def test_palette_size(num_colours):
+    image = synthetic_image(64, 48)
+    palette = octree_palette(image, num_colours, max_leaves=256, chunk=500)
+    assert len(palette) == num_colours
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+
+from glitches.colour import mono_palette
+from glitches.dithering import FS_TOLERANCES, floyd_steinberg
+from glitches.synthetic import block_means, synthetic_image, \
+    synthetic_palette
+
+
+# Floyd-Steinberg working precisions against the double reference
+
+
+def dither(mode, precision, size=(96, 64), num_colours=16):
+    image = synthetic_image(size[0], size[1], seed=num_colours)
+    if mode == "MONO":
+        image = image.convert("L")
+        palette = mono_palette(num_colours)
+    else:
+        palette = synthetic_palette(num_colours)
+    return np.asarray(floyd_steinberg(image, palette, mode,
+                                      precision=precision))
+
+
+@pytest.mark.parametrize("mode", ["RGB", "MONO"])
+@pytest.mark.parametrize("num_colours", [2, 16, 64])
+@pytest.mark.parametrize("precision", sorted(FS_TOLERANCES))
+def test_tolerances(mode, num_colours, precision):
+    block_tol, mean_tol = FS_TOLERANCES[precision]
+    ref = dither(mode, "double", num_colours=num_colours)
+    out = dither(mode, precision, num_colours=num_colours)
+    assert np.abs(block_means(out) - block_means(ref)).max() <= block_tol
+    assert abs(out.mean() - ref.mean()) <= mean_tol
+
+
+@pytest.mark.parametrize("mode", ["RGB", "MONO"])
+@pytest.mark.parametrize("precision", ["double", "float32", "int32",
+                                       "int16"])
+def test_deterministic(mode, precision):
+    assert (dither(mode, precision) == dither(mode, precision)).all()
+
+
+@pytest.mark.parametrize("mode", ["RGB", "MONO"])
+@pytest.mark.parametrize("num_colours", [2, 16, 64])
+def test_fixed_point_widths_agree(mode, num_colours):
+    int32 = dither(mode, "int32", num_colours=num_colours)
+    int16 = dither(mode, "int16", num_colours=num_colours)
+    assert (int32 == int16).all()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+import zx
+from glitches import scr
+from glitches.synthetic import synthetic_image
+
+
+# ZX Spectrum screen memory
+
+
+def screen_address(y, x):
+    """ Byte offset of pixel (x, y) in screen memory, as the ROM sees it. """
+    return ((y & 0xC0) << 5) | ((y & 0x07) << 8) | ((y & 0x38) << 2) | \
+        (x >> 3)
+
+
+def random_screen(seed=0):
+    rng = np.random.RandomState(seed)
+    bits = rng.randint(0, 2, (scr.HEIGHT, scr.WIDTH)).astype(bool)
+    attrs = rng.randint(0, 256, (scr.CELLS_Y, scr.CELLS_X)).astype(np.uint8)
+    return bits, attrs
+
+
+def test_round_trip():
+    bits, attrs = random_screen()
+    data = scr.encode(bits, attrs)
+    assert len(data) == scr.SCR_BYTES
+    got_bits, got_attrs = scr.split(data)
+    assert (got_bits == bits).all()
+    assert (got_attrs == attrs).all()
+    assert scr.encode(got_bits, got_attrs) == data
+
+
+def test_pixels_land_on_their_lines():
+    attrs = np.zeros((scr.CELLS_Y, scr.CELLS_X), dtype=np.uint8)
+    for y, x in [(0, 0), (1, 3), (8, 255), (63, 17), (64, 128), (191, 200)]:
+        bits = np.zeros((scr.HEIGHT, scr.WIDTH), dtype=bool)
+        bits[y, x] = True
+        data = bytearray(scr.encode(bits, attrs))
+        assert data[screen_address(y, x)] == 0x80 >> (x & 7)
+        data[screen_address(y, x)] = 0
+        assert not any(data)
+
+
+def test_decode_colours():
+    bits = np.zeros((scr.HEIGHT, scr.WIDTH), dtype=bool)
+    bits[:8, :8] = True
+    attrs = np.zeros((scr.CELLS_Y, scr.CELLS_X), dtype=np.uint8)
+    attrs[0, 0] = scr.attributes(ink=2, paper=1, bright=True)
+    attrs[0, 1] = scr.attributes(ink=2, paper=1, bright=False)
+    rgb = scr.decode(scr.encode(bits, attrs))
+    assert tuple(rgb[0, 0]) == scr.ZX_BRIGHT[2]
+    assert tuple(rgb[0, 8]) == scr.ZX_BASIC[1]
+    assert tuple(rgb[191, 255]) == scr.ZX_BASIC[0]
+
+
+def test_zx_scr_matches_zx_screen():
+    image = synthetic_image(256, 192)
+    rendered = np.asarray(zx.zx_screen(image))
+    assert (scr.decode(zx.zx_scr(image)) == rendered).all()
@@ -1,121 +1,184 @@
 #!/usr/bin/env python
 
-import glitches.dithering as gl_d
-import glitches.colour as gl_c
 import glitches.util as gl_u
-from PIL import Image, ImageOps, ImageColor
+import glitches.instrument as gl_i
+import glitches.scr as gl_s
+from glitches.scr import ZX_BASIC, ZX_BRIGHT, ZX_PALETTES, CELLS_Y, CELLS_X
+from PIL import Image
 from argparse import ArgumentParser
-from operator import itemgetter
-import math
 import numpy as np
+import os
+import sys
 
-ZX_BASIC = ["#000000", "#0000CD", "#CD0000", "#CD00CD",
-             "#00CD00", "#00CDCD", "#CDCD00", "#CDCDCD"]
-ZX_BASIC = [ImageColor.getrgb(c) for c in ZX_BASIC]
+ZX_HEX = ZX_BASIC + ZX_BRIGHT
 
-ZX_BRIGHT = ["#000000", "#0000FF", "#FF0000", "#FF00FF",
-             "#00FF00", "#00FFFF", "#FFFF00", "#FFFFFF"]
-ZX_BRIGHT = [ImageColor.getrgb(c) for c in ZX_BRIGHT]
 
-ZX_HEX = ZX_BASIC + ZX_BRIGHT
+def screen_cells(image):
+    """ 256x192 image as a (24, 32, 8, 8, 3) array of attribute cells. """
+    im_array = np.asarray(image.convert("RGB"), dtype=np.intp)
+    im_array = im_array.reshape((CELLS_Y, 8, CELLS_X, 8, 3))
+    return im_array.transpose((0, 2, 1, 3, 4))
+
+
+def cells_screen(cells):
+    """ Inverse of screen_cells. """
+    return cells.transpose((0, 2, 1, 3, 4)).reshape((192, 256, 3))
+
+
+def pair_table():
+    """ Every legal attribute colour pair.
+
+    Of the 2 x 8 x 7 combinations of brightness, ink and a different paper,
+    swapping ink and paper never changes how well a cell is matched, so only
+    the 2 x 28 pairs with ink < paper are kept. Returns (bright, ink, paper)
+    arrays.
+    """
+    bright, ink, paper = np.meshgrid(np.arange(2), np.arange(8), np.arange(8),
+                                     indexing='ij')
+    legal = ink < paper
+    return bright[legal], ink[legal], paper[legal]
+
+
+PAIR_BRIGHT, PAIR_INK, PAIR_PAPER = pair_table()
+
 
+def best_pairs(cells):
+    """ Best ink/paper pair and brightness for every cell.
 
-def colour_dist(a, b):
-    dist = 0
-    for aa, bb in zip(a, b):
-        dist += (aa - bb) ** 2
-    return math.sqrt(dist)
+    Each cell is scored against all legal pairs at once. Since the cell is
+    dithered afterwards, a pixel's cost is its squared distance to the
+    nearest mix of the two colours, i.e. to the segment joining them.
+    Returns (N, 2) palette indices and an (N,) bright flag.
+    """
+    colours = ZX_PALETTES.astype(np.float32)
+    ink = colours[PAIR_BRIGHT, PAIR_INK]
+    span = colours[PAIR_BRIGHT, PAIR_PAPER] - ink
+    span_sq = (span ** 2).sum(axis=-1)
 
+    # Offsets from ink expanded into dot products, one matrix product each
+    pixels = cells.reshape((-1, 3)).astype(np.float32)
+    offset_sq = ((pixels ** 2).sum(axis=-1)[:, None] -
+                 2.0 * np.dot(pixels, ink.T) + (ink ** 2).sum(axis=-1))
+    along = np.dot(pixels, span.T) - (ink * span).sum(axis=-1)
 
-def nearest_colour(colour, palette):
-    nearest = -1
-    near_dist = -1
-    for i in range(len(palette)):
-        c = palette[i]
-        c_dist = colour_dist(colour, c)
-        if near_dist == -1 or c_dist < near_dist:
-            near_dist = c_dist
-            nearest = i
-    return palette[nearest], near_dist, nearest
+    t = np.clip(along / span_sq, 0, 1)
+    error = offset_sq - 2.0 * t * along + t * t * span_sq
+    score = error.reshape((-1, 64, ink.shape[0])).sum(axis=1)
 
+    best = np.argmin(score, axis=1)
+    indices = np.stack((PAIR_INK[best], PAIR_PAPER[best]), axis=1)
+    return indices, PAIR_BRIGHT[best].astype(bool)
 
-def match_colours(colours, palette):
-    # XXX Dreadful, absolutely dreadful
-    if len(colours) == 1:
-        am, ams, amidx = nearest_colour(colours[0], palette)
-        return [am], ams
-    else:
-        a, b = colours
 
-        # Colour A
-        am, ams, amidx = nearest_colour(a, palette)
+def dither_cells(cells, pairs):
+    """ Floyd-Steinberg dither every cell to its own pair of colours.
 
-        # Colour B
-        palette_2 = palette[:amidx] + palette[amidx + 1:]
-        bm, bms, bmidx = nearest_colour(b, palette_2)
+    Error stays within each cell. All cells advance together one pixel at a
+    time. Returns the (N, 8, 8) choice of colour (0 or 1) for every pixel.
+    """
+    work = cells.reshape((-1, 8, 8, 3)).astype(np.double)
+    pairs = pairs.astype(np.double)
+    choice = np.zeros(work.shape[:3], dtype=np.intp)
+    for y in range(8):
+        for x in range(8):
+            old = np.clip(work[:, y, x], 0, 255)
+            dist = ((old[:, None, :] - pairs) ** 2).sum(axis=-1)
+            pick = (dist[:, 1] < dist[:, 0]).astype(np.intp)
+            choice[:, y, x] = pick
 
-        return [am, bm], ams + bms
+            error = old - pairs[np.arange(pairs.shape[0]), pick]
+            if x < 7:
+                work[:, y, x + 1] += error * (7.0 / 16.0)
+            if y < 7:
+                if x > 0:
+                    work[:, y + 1, x - 1] += error * (3.0 / 16.0)
+                work[:, y + 1, x] += error * (5.0 / 16.0)
+                if x < 7:
+                    work[:, y + 1, x + 1] += error * (1.0 / 16.0)
+    return choice
 
 
-def attribute_block(image, x, y):
-    # Copy and load block
-    block = image.crop((x, y, x + 8, y + 8))
-    block.load()
+def zx_cells(image):
+    """ Per-cell decisions for a 256x192 image: (N, 2) ink and paper
+    indices, an (N,) bright flag and the (N, 8, 8) choice of ink (0) or
+    paper (1) for every pixel. """
+    cells = screen_cells(image)
+    with gl_i.stage("attributes", 256 * 192):
+        indices, bright = best_pairs(cells)
 
-    # Get top colours in block
-    cols = gl_c.median_cut(block, 2)
+    pairs = ZX_PALETTES[bright.astype(np.intp)[:, None], indices]
+    with gl_i.stage("dither", 256 * 192):
+        choice = dither_cells(cells, pairs)
+    return indices, bright, choice
 
-    # Match to basic and bright palettes
-    a_cols, a_score = match_colours(cols, ZX_BASIC)
-    b_cols, b_score = match_colours(cols, ZX_BRIGHT)
 
-    if (a_score < b_score):
-        return gl_d.floyd_steinberg(block, a_cols)
-    else:
-        return gl_d.floyd_steinberg(block, b_cols)
+def zx_screen(image):
+    """ Convert a 256x192 image to Spectrum attribute cells in one pass. """
+    indices, bright, choice = zx_cells(image)
+    pairs = ZX_PALETTES[bright.astype(np.intp)[:, None], indices]
+    out = pairs[np.arange(pairs.shape[0])[:, None, None], choice]
+    out = out.reshape((CELLS_Y, CELLS_X, 8, 8, 3))
+    return Image.fromarray(cells_screen(out).astype(np.uint8))
+
+
+def zx_scr(image):
+    """ Convert a 256x192 image straight to 6912 bytes of .scr screen. """
+    indices, bright, choice = zx_cells(image)
+    attrs = gl_s.attributes(indices[:, 0], indices[:, 1], bright)
+    bits = (choice == 0).reshape((CELLS_Y, CELLS_X, 8, 8))
+    bits = bits.transpose((0, 2, 1, 3)).reshape((192, 256))
+    return gl_s.encode(bits, attrs.reshape((CELLS_Y, CELLS_X)))
+
+
+def is_scr(path):
+    return os.path.splitext(path)[1].lower() == ".scr"
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("inage", metavar='INPUT', type=str)
     parser.add_argument("outage", metavar='OUTPUT', type=str)
-    parser.add_argument("-d", "--dither", type=str, default="BAYER")
-    parser.add_argument("-m", "--matrix", type=int, default=-2)
+    # Cells are always dithered to their ink and paper, these options are
+    # accepted so existing command lines keep working
+    parser.add_argument("-d", "--dither", type=str, default="BAYER",
+                        help="ignored, kept for compatibility")
+    parser.add_argument("-m", "--matrix", type=int, default=-2,
+                        help="ignored, kept for compatibility")
     parser.add_argument("-e", "--equalize", action="store_true", default=False)
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="write per-stage timings and memory as JSON "
+                             "lines to stderr")
     args = parser.parse_args()
 
-    image = Image.open(args.inage)
-
-    if args.equalize:
-        image = ImageOps.equalize(image)
-
-    # Resize Image
-    image = gl_u.resize(image, 256, 192)
-
-    # Pre-quantize image
-    #image = gl_c.quantize(image, gl_c.median_cut(image, 32))
-    # image = gl_d.floyd_steinberg(image, ZX_HEX)
-    # image.save(args.outage)
-    # exit()
-
-    # Quantize
-    # outim = gl_c.quantize(image, palette)
-    outim = Image.new("RGB", image.size, "black")
-    
-    for x in range(256 >> 3):
-        for y in range(192 >> 3):
-            block = attribute_block(image, x << 3, y << 3)
-            outim.paste(block, (x << 3, y << 3))
-    # Dither image based on monochrome palette
-    #if args.dither.upper() == "FS":
-        #dithim = gl_d.floyd_steinberg(image, monos, mode="MONO").convert("RGB")
-    #elif args.dither.upper() == "BAYER":
-        #dithim = gl_d.bayer(image, monos, matrix=args.matrix).convert("RGB")
-    #else:
-        #dithim = gl_d.bayer(image, monos, matrix=args.matrix).convert("RGB")
+    if args.profile:
+        gl_i.subscribe(gl_i.json_writer(sys.stderr))
+        gl_i.start_tracing()
+
+    # A .scr input is only decoded, e.g. to view it as a PNG
+    if is_scr(args.inage):
+        with gl_i.stage("decode", 256 * 192):
+            outim = gl_s.scr_image(gl_s.read_scr(args.inage))
+        with gl_i.stage("save", 256 * 192):
+            outim.save(args.outage)
+        return
+
+    # Load straight into a 256x192 screen
+    with gl_i.stage("load", 256 * 192):
+        image = gl_u.load(args.inage, 256, 192, equalize=args.equalize)
+
+    # Write screen memory as it is, without rendering pixels
+    if is_scr(args.outage):
+        scr = zx_scr(image)
+        with gl_i.stage("save", 256 * 192):
+            gl_s.write_scr(scr, args.outage)
+        return
+
+    # Pick attributes and dither each cell to its ink and paper
+    outim = zx_screen(image)
 
     # Save zx-ified
-    outim.save(args.outage)
+    with gl_i.stage("save", 256 * 192):
+        outim.save(args.outage)
 
 if __name__ == '__main__':
     main()